@@ -1,5 +1,4 @@
 import pandas as pd
-import anndata as ad
 import sys
 
 ## VIASH START
@@ -13,27 +12,25 @@ par = {
 ## VIASH END
 
 sys.path.append(meta["resources_dir"])
-from anndata_to_dataframe import anndata_to_dataframe
+from read_layer import read_layer, grouped_mean, lookup_codes
+from write_prediction import write_prediction
 
-de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
+de_train = read_layer(par["de_train_h5ad"], par["layer"], obs_columns=["cell_type"])
 id_map = pd.read_csv(par["id_map"])
-gene_names = list(de_train_h5ad.var_names)
-de_train = anndata_to_dataframe(de_train_h5ad, par["layer"])
+gene_names = list(de_train.var_names)
 
 # compute mean celltype
-mean_celltype = de_train.groupby("cell_type")[gene_names].mean()
-mean_celltype = mean_celltype.loc[id_map.cell_type]
+mean_celltype = grouped_mean(de_train.layer, de_train.obs_codes["cell_type"])
 
 # write output
-output = ad.AnnData(
-    layers={
-        "prediction": mean_celltype.values
-    },
-    obs=pd.DataFrame(index=id_map["id"]),
-    var=pd.DataFrame(index=gene_names),
+write_prediction(
+    par["output"],
+    mean_celltype,
+    lookup_codes(de_train.obs_categories["cell_type"], id_map.cell_type),
+    obs_names=id_map["id"],
+    var_names=gene_names,
     uns={
-      "dataset_id": de_train_h5ad.uns["dataset_id"],
+      "dataset_id": de_train.uns["dataset_id"],
       "method_id": meta["functionality_name"]
     }
 )
-output.write_h5ad(par["output"], compression="gzip")
\ No newline at end of file
@@ -1,5 +1,4 @@
 import pandas as pd
-import anndata as ad
 import sys
 
 ## VIASH START
@@ -13,26 +12,24 @@ par = {
 ## VIASH END
 
 sys.path.append(meta["resources_dir"])
-from anndata_to_dataframe import anndata_to_dataframe
+from read_layer import read_layer, grouped_mean, lookup_codes
+from write_prediction import write_prediction
 
-de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
+de_train = read_layer(par["de_train_h5ad"], par["layer"], obs_columns=["sm_name"])
 id_map = pd.read_csv(par["id_map"])
-gene_names = list(de_train_h5ad.var_names)
-de_train = anndata_to_dataframe(de_train_h5ad, par["layer"])
+gene_names = list(de_train.var_names)
 
-mean_compound = de_train.groupby("sm_name")[gene_names].mean()
-mean_compound = mean_compound.loc[id_map.sm_name]
+mean_compound = grouped_mean(de_train.layer, de_train.obs_codes["sm_name"])
 
 # write output
-output = ad.AnnData(
-    layers={
-        "prediction": mean_compound.values
-    },
-    obs=pd.DataFrame(index=id_map["id"]),
-    var=pd.DataFrame(index=gene_names),
+write_prediction(
+    par["output"],
+    mean_compound,
+    lookup_codes(de_train.obs_categories["sm_name"], id_map.sm_name),
+    obs_names=id_map["id"],
+    var_names=gene_names,
     uns={
-      "dataset_id": de_train_h5ad.uns["dataset_id"],
+      "dataset_id": de_train.uns["dataset_id"],
       "method_id": meta["functionality_name"]
     }
 )
-output.write_h5ad(par["output"], compression="gzip")
\ No newline at end of file
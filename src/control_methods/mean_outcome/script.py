@@ -1,5 +1,4 @@
 import pandas as pd
-import anndata as ad
 import numpy as np
 import sys
 
@@ -14,25 +13,23 @@ par = {
 ## VIASH END
 
 sys.path.append(meta["resources_dir"])
-from anndata_to_dataframe import anndata_to_dataframe
+from read_layer import read_layer
+from write_prediction import write_constant_prediction
 
-de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
+de_train = read_layer(par["de_train_h5ad"], par["layer"])
 id_map = pd.read_csv(par["id_map"])
-gene_names = list(de_train_h5ad.var_names)
-de_train = anndata_to_dataframe(de_train_h5ad, par["layer"])
+gene_names = list(de_train.var_names)
 
-mean_pred = de_train[gene_names].mean(axis=0)
+mean_pred = de_train.layer.mean(axis=0, dtype=np.float64).astype(np.float32)
 
 # write output
-output = ad.AnnData(
-    layers={
-        "prediction": np.vstack([mean_pred.values] * id_map.shape[0])
-    },
-    obs=pd.DataFrame(index=id_map["id"]),
-    var=pd.DataFrame(index=gene_names),
+write_constant_prediction(
+    par["output"],
+    mean_pred,
+    obs_names=id_map["id"],
+    var_names=gene_names,
     uns={
-      "dataset_id": de_train_h5ad.uns["dataset_id"],
+      "dataset_id": de_train.uns["dataset_id"],
       "method_id": meta["functionality_name"]
     }
 )
-output.write_h5ad(par["output"], compression="gzip")
\ No newline at end of file
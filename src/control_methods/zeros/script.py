@@ -1,6 +1,6 @@
-import anndata as ad
 import numpy as np
 import pandas as pd
+import sys
 
 ## VIASH START
 par = {
@@ -12,20 +12,23 @@ par = {
 }
 ## VIASH END
 
-de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
-id_map = pd.read_csv(par["id_map"])
-gene_names = list(de_train_h5ad.var_names)
+sys.path.append(meta["resources_dir"])
+from read_layer import read_layer
+from write_prediction import write_constant_prediction
 
-prediction = np.zeros((id_map.shape[0], len(gene_names)))
+# only the var names and the dataset id are needed
+de_train = read_layer(par["de_train_h5ad"], None)
+id_map = pd.read_csv(par["id_map"])
+gene_names = list(de_train.var_names)
 
-# write output
-output = ad.AnnData(
-    layers={"prediction": prediction},
-    obs=pd.DataFrame(index=id_map["id"]),
-    var=pd.DataFrame(index=gene_names),
+# write output, the zero rows are never materialized
+write_constant_prediction(
+    par["output"],
+    np.zeros(len(gene_names)),
+    obs_names=id_map["id"],
+    var_names=gene_names,
     uns={
-      "dataset_id": de_train_h5ad.uns["dataset_id"],
+      "dataset_id": de_train.uns["dataset_id"],
       "method_id": meta["functionality_name"]
     }
 )
-output.write_h5ad(par["output"], compression="gzip")
\ No newline at end of file
@@ -1,10 +1,13 @@
-from typing import List
+from typing import List, Optional, Tuple
 import numpy as np
 import tqdm
 import torch
-import category_encoders
+import torch.utils.checkpoint
 
 # local import
+from worker_pool import available_cores, fork_pool
+
+
 def plant_seed(seed: int, USE_GPU:bool = True) -> None:
     """Set seed for reproducibility purposes.
     
@@ -23,22 +26,24 @@ class MultiOutputTargetEncoder:
     """Multi-output target encoder.
     
     Each input (categorical) feature will be encoded based on each (continuous) output variable.
+    The encoding follows `category_encoders.LeaveOneOutEncoder`, but is computed for all
+    output variables at once from per-category sums and counts.
     
     Attributes:
-        encoders: List of encoders, of shape `n_genes`.
+        categories: List of arrays, of shape `n_features`, containing the sorted categories
+            of each input feature.
+        sums: List of arrays, of shape `n_features`, each of shape `(n_categories, n_genes)`
+            containing the sum of the output variables for each category.
+        counts: List of arrays, of shape `n_features`, each of shape `(n_categories,)`
+            containing the number of occurrences of each category.
+        mean: Array of shape `(n_genes,)` containing the global mean of each output variable.
     """
     
     def __init__(self):
-        self.encoders: List[category_encoders.leave_one_out.LeaveOneOutEncoder] = []
-        
-    @staticmethod
-    def new_encoder() -> category_encoders.leave_one_out.LeaveOneOutEncoder:
-        """Instantiates a new gene-specific target encoder.
-        
-        Returns:
-            New instance of a target encoder.
-        """
-        return category_encoders.leave_one_out.LeaveOneOutEncoder(return_df=False)
+        self.categories: List[np.ndarray] = []
+        self.sums: List[np.ndarray] = []
+        self.counts: List[np.ndarray] = []
+        self.mean: Optional[np.ndarray] = None
     
     def fit(self, X: np.ndarray, y: np.ndarray) -> None:
         """Fit the encoders for each input feature and output variable.
@@ -48,27 +53,55 @@ class MultiOutputTargetEncoder:
                 Typical, `n_features` is equal to 2 (cell type + compound).
             y: Array of shape `(n, n_genes)` containing the DE values for all the genes.
         """
-        self.encoders = []
-        for j in tqdm.tqdm(range(y.shape[1]), desc='fit LOO encoders'):
-            self.encoders.append(MultiOutputTargetEncoder.new_encoder())
-            self.encoders[-1].fit(X, y[:, j])
+        X = np.asarray(X)
+        y = np.asarray(y, dtype=np.float64)
+        self.categories, self.sums, self.counts = [], [], []
+        self.mean = y.mean(axis=0)
+        for k in range(X.shape[1]):
+            categories, codes = np.unique(X[:, k], return_inverse=True)
+            
+            # Segment sums: sort the rows by category once, then sum each contiguous block
+            order = np.argsort(codes, kind='stable')
+            counts = np.bincount(codes, minlength=len(categories))
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            
+            self.categories.append(categories)
+            self.sums.append(np.add.reduceat(y[order], starts, axis=0))
+            self.counts.append(counts)
     
-    def transform(self, X: np.ndarray) -> np.ndarray:
+    def transform(self, X: np.ndarray, y: Optional[np.ndarray] = None) -> np.ndarray:
         """Encodes the categories. Assumes the encoders have already been fitted.
         
+        Without targets, each category is replaced by its mean target. With targets, the
+        target of the row itself is left out of the mean. Categories that occur only once
+        during fitting, as well as unknown categories, are replaced by the global mean.
+        
         Args:
             X: Array of shape `(n, n_features)` containing categories as strings or integers.
+            y: Optional array of shape `(n, n_genes)` containing the targets to leave out.
         
         Returns:
             Array of shape `(n, n_genes, n_features)` containing the encoding of each input
                 feature with respect to each output variable.
         """
-        Z = []
-        for encoder in tqdm.tqdm(self.encoders, desc='transform LOO encoders'):
-            y_hat = encoder.transform(X)
-            Z.append(y_hat)
-        Z = np.asarray(Z)
-        return np.transpose(Z, (1, 0, 2))
+        X = np.asarray(X)
+        if y is not None:
+            y = np.asarray(y, dtype=np.float64)
+        Z = np.empty((X.shape[0], len(self.mean), X.shape[1]), dtype=np.float64)
+        for k, (categories, sums, counts) in enumerate(zip(self.categories, self.sums, self.counts)):
+            
+            # Map each value to its category code, unknown categories are flagged separately
+            codes = np.clip(np.searchsorted(categories, X[:, k]), 0, len(categories) - 1)
+            known = categories[codes] == X[:, k]
+            
+            row_counts = counts[codes]
+            if y is None:
+                Z[:, :, k] = sums[codes] / row_counts[:, None]
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    Z[:, :, k] = (sums[codes] - y) / (row_counts - 1)[:, None]
+            Z[~known | (row_counts <= 1), :, k] = self.mean
+        return Z
 
 class NN(torch.nn.Module):
     """Deep learning architecture composed of 2 modules: a sample-centric MLP
@@ -85,9 +118,11 @@ class NN(torch.nn.Module):
         net1: Sparse MLP defined by the gene-pathway network.
         net2: Sparse MLP defined by the co-accessibility network.
         net3: Sparse MLP defined by the gene regulatory network.
+        gene_chunk_size: If not None, the gene-centric MLP is evaluated on chunks of
+            this many genes at a time, which bounds the size of its intermediate tensors.
     """
     
-    def __init__(self, n_genes: int, n_input_channels: int):
+    def __init__(self, n_genes: int, n_input_channels: int, gene_chunk_size: Optional[int] = None):
         torch.nn.Module.__init__(self)
         
         # Total number of genes
@@ -154,6 +189,8 @@ class NN(torch.nn.Module):
         self.net2 = None
         self.net3 = None
         
+        self.gene_chunk_size: Optional[int] = gene_chunk_size
+        
         # Xavier initialization
         def init_weights(m):
             if isinstance(m, torch.nn.Linear):
@@ -184,6 +221,9 @@ class NN(torch.nn.Module):
         # (batch_size*n_genes, n_output_channels)
         Y = Y.reshape(-1, self.n_output_channels)
         
+        if self.gene_chunk_size is not None:
+            return self._forward_gene_chunks(X, Y.reshape(len(X), self.n_genes, self.n_output_channels))
+        
         # Concatenate input and output channels into (batch_size, n_genes*n_channels)
         # and process with gene-centric MLP
         Y = torch.cat((X.reshape(-1, self.n_input_channels), Y), dim=1)
@@ -193,6 +233,38 @@ class NN(torch.nn.Module):
         Y = Y.reshape(len(X), -1)
 
         return Y
+    
+    def _mlp2_chunk(self, X: torch.Tensor, Y: torch.Tensor) -> torch.Tensor:
+        # The first layer of the gene-centric MLP is split into its input and output
+        # channel parts, which avoids materializing the concatenated channels
+        weight = self.mlp2[0].weight
+        H = X.reshape(-1, self.n_input_channels) @ weight[:, :self.n_input_channels].T
+        H = H + Y.reshape(-1, self.n_output_channels) @ weight[:, self.n_input_channels:].T
+        return self.mlp2[1:](H).reshape(len(X), -1)
+    
+    def _forward_gene_chunks(self, X: torch.Tensor, Y: torch.Tensor) -> torch.Tensor:
+        """Evaluates the gene-centric MLP on chunks of `gene_chunk_size` genes.
+        
+        Args:
+            X: Input channels, of shape `(batch_size, n_genes, n_input_channels)`.
+            Y: Output channels of the sample-centric MLP, of shape
+                `(batch_size, n_genes, n_output_channels)`.
+        
+        Returns:
+            Estimated DE values, of shape `(batch_size, n_genes)`.
+        """
+        out = X.new_empty((len(X), self.n_genes))
+        for start in range(0, self.n_genes, self.gene_chunk_size):
+            end = min(start + self.gene_chunk_size, self.n_genes)
+            if torch.is_grad_enabled():
+                # Recompute the activations of the chunk during the backward pass
+                # instead of keeping them for all genes at once
+                chunk = torch.utils.checkpoint.checkpoint(
+                    self._mlp2_chunk, X[:, start:end], Y[:, start:end], use_reentrant=False)
+            else:
+                chunk = self._mlp2_chunk(X[:, start:end], Y[:, start:end])
+            out[:, start:end] = chunk
+        return out
 
 def background_noise(
     *size: int,
@@ -319,3 +391,115 @@ def train(
         # Show relative error
         pbar.set_description(f'{rel_error:.3f}')
     return model
+
+
+# Training data of the replica workers, inherited from the parent process when forking
+_replica_data = {}
+
+
+def _train_replica(job: Tuple[int, int]) -> dict:
+    seed, n_iter = job
+    X, Y = _replica_data['X'], _replica_data['Y']
+    model = train(X, Y, np.arange(len(X)), seed, n_iter=n_iter, USE_GPU=False,
+                  gene_chunk_size=_replica_data['gene_chunk_size'])
+    return model.state_dict()
+
+
+def train_replicas(
+        X: torch.Tensor,
+        Y: torch.Tensor,
+        jobs: List[Tuple[int, int]],
+        USE_GPU: bool = True,
+        n_workers: Optional[int] = None,
+        threads_per_worker: int = 1,
+        gene_chunk_size: Optional[int] = None) -> List[NN]:
+    """Trains one model per job and returns them, in the order of the jobs.
+    
+    On CPU, the replicas are trained on a pool of forked worker processes, each running
+    `threads_per_worker` torch threads. Since every replica is seeded with its own seed,
+    the result of a job does not depend on the worker that runs it. With a GPU, or a
+    single worker, the replicas are trained sequentially in the current process.
+    
+    Args:
+        X: Input features. A tensor of shape `(n, n_genes, n_input_channels)`.
+        Y: Output variables. A tensor of shape `(n, n_genes)`.
+        jobs: List of `(seed, n_iter)` tuples, one per replica.
+        USE_GPU: Whether to train on the GPU.
+        n_workers: Number of worker processes. Defaults to as many workers as fit on
+            the available cores.
+        threads_per_worker: Number of torch threads per worker.
+        gene_chunk_size: Number of genes per chunk of the gene-centric MLP (see `NN`).
+    
+    Returns:
+        Trained models, in evaluation mode.
+    """
+    n_workers = n_workers or max(1, len(available_cores()) // threads_per_worker)
+    n_workers = min(n_workers, len(jobs))
+    
+    models = []
+    if USE_GPU or n_workers == 1:
+        # CUDA cannot be used in forked workers, so train in-process
+        for seed, n_iter in jobs:
+            model = train(X, Y, np.arange(len(X)), seed, n_iter=n_iter, USE_GPU=USE_GPU,
+                          gene_chunk_size=gene_chunk_size)
+            model.eval()
+            models.append(model)
+            torch.cuda.empty_cache()
+        return models
+    
+    print(f'Training {len(jobs)} replicas on {n_workers} workers', flush=True)
+    _replica_data.update(X=X.cpu(), Y=Y.cpu(), gene_chunk_size=gene_chunk_size)
+    try:
+        with fork_pool(n_workers, threads_per_worker) as pool:
+            state_dicts = pool.map(_train_replica, jobs, chunksize=1)
+    finally:
+        _replica_data.clear()
+    for state_dict in state_dicts:
+        model = NN(X.shape[1], X.shape[2], gene_chunk_size=gene_chunk_size)
+        model.load_state_dict(state_dict)
+        model.eval()
+        models.append(model)
+    return models
+
+
+def predict(
+        models: List[NN],
+        X: torch.Tensor,
+        batch_size: int = 64,
+        decimals: Optional[int] = None) -> np.ndarray:
+    """Predicts DE values using a simple ensembling strategy: the median of the
+    predictions across the different models.
+    
+    Each model is run once over all rows of `X`, in batches, on the device where
+    the model parameters are stored.
+    
+    Args:
+        models: Trained models.
+        X: Input features. A tensor of shape `(n, n_genes, n_input_channels)`.
+        batch_size: Number of rows processed per forward pass.
+        decimals: If not None, the predictions are rounded to this number of decimals.
+    
+    Returns:
+        Array of shape `(n, n_genes)` containing the predicted DE values, as float32.
+    """
+    Y = []
+    with torch.inference_mode():
+        for model in models:
+            device = next(model.parameters()).device
+            Y.append(torch.cat([
+                model.forward(x.to(device)).cpu()
+                for x in torch.split(X, batch_size)
+            ]))
+    
+    # Median across models, averaging the two middle values for an even number of models.
+    # This is computed in float32, like `np.median` does on the float32 predictions.
+    Y = torch.sort(torch.stack(Y), dim=0).values
+    m = len(models) // 2
+    y_hat = Y[m] if len(models) % 2 == 1 else (Y[m - 1] + Y[m]) / 2
+    y_hat = y_hat.numpy()
+    
+    if decimals is not None:
+        # Round through the decimal representation, as `f'{x:.5f}'` does. `np.round`
+        # scales by a power of ten first and can end up 1e-5 away on ties.
+        y_hat = np.char.mod(f'%.{decimals}f', y_hat)
+    return y_hat.astype(np.float32)
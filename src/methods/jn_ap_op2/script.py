@@ -17,7 +17,10 @@ par = {
     "id_map": "resources/neurips-2023-kaggle/id_map.csv",
     "output": "output.h5ad",
     "n_replica": 1,
-    "submission_names": ["dl40"]
+    "submission_names": ["dl40"],
+    "n_workers": None,
+    "threads_per_worker": 1,
+    "gene_chunk_size": None
 }
 meta = {
     "resources_dir": "src/methods/jn_ap_op2",
@@ -26,7 +29,7 @@ meta = {
 
 sys.path.append(meta["resources_dir"])
 
-from helper import plant_seed, MultiOutputTargetEncoder, train
+from helper import plant_seed, MultiOutputTargetEncoder, train_replicas, predict
 
 print('Reading input files', flush=True)
 de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
@@ -76,36 +79,28 @@ if USE_GPU:
 print('Generate predictions', flush=True)
 # ... generate predictions ...
 
+# train the models of all submissions at once, so the replicas can be trained in parallel
+n_iters = {'dl40': 40, 'dl200': 200}
+jobs = [
+    (seed, n_iters.get(SUBMISSION_NAME, 40))
+    for SUBMISSION_NAME in par["submission_names"]
+    for seed in range(par["n_replica"])
+]
+all_models = train_replicas(
+    X, torch.FloatTensor(data), jobs,
+    USE_GPU=USE_GPU,
+    n_workers=par["n_workers"],
+    threads_per_worker=par["threads_per_worker"],
+    gene_chunk_size=par["gene_chunk_size"]
+)
+
 Y_submit_ensemble = []
-for SUBMISSION_NAME in par["submission_names"]:
-  #train the models and store them
-  models = []
-  for i in range(par["n_replica"] ):
-      seed = i
-      if SUBMISSION_NAME == 'dl40':
-          model = train(X, torch.FloatTensor(data), np.arange(len(X)), seed, n_iter=40, USE_GPU=USE_GPU)
-      elif SUBMISSION_NAME == 'dl200':
-          model = train(X, torch.FloatTensor(data), np.arange(len(X)), seed, n_iter=200, USE_GPU=USE_GPU)
-      else:
-          model = train(X, torch.FloatTensor(data), np.arange(len(X)), seed, n_iter=40, USE_GPU=USE_GPU)
-      model.eval()
-      models.append(model)
-      torch.cuda.empty_cache()
-  # predict 
-  Y_submit =  []
-  for i, x in tqdm.tqdm(enumerate(X_submit), desc='Submission'):
-    # Predict on test sample using a simple ensembling strategy:
-    # take the median of the predictions across the different models
-    y_hat = []
-    for model in models:
-        model = model.cpu()
-        y_hat.append(np.squeeze(model.forward(x.unsqueeze(0)).cpu().data.numpy()))
-    y_hat = np.median(y_hat, axis=0)
-
-    values = [f'{x:.5f}' for x in y_hat]
-    Y_submit.append(values)
-    
-  Y_submit_ensemble.append(np.asarray(Y_submit).astype(np.float32))
+for i, SUBMISSION_NAME in enumerate(par["submission_names"]):
+  models = all_models[i * par["n_replica"]:(i + 1) * par["n_replica"]]
+  # Predict on test samples using a simple ensembling strategy:
+  # take the median of the predictions across the different models
+  Y_submit = predict(models, X_submit, decimals=5)
+  Y_submit_ensemble.append(Y_submit)
     
 Y_submit_final = np.mean(Y_submit_ensemble, axis=0)
 
@@ -14,6 +14,8 @@ workflow run_wf {
         "layer",
         "epochs",
         "kf_n_splits",
+        "batch_size",
+        "pin_memory",
         "models",
         "schemes"
       ],
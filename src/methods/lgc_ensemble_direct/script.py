@@ -12,11 +12,17 @@ else:
 par = {
     "de_train": "resources/neurips-2023-data/de_train.h5ad",
     "id_map": "resources/neurips-2023-data/id_map.csv",
-    "models": ["initial", "light"],
+    "schemes": ["initial", "light"],
+    "models": ["LSTM", "GRU"],
     "epochs": 1,
     "kf_n_splits": 2,
+    "batch_size": 16,
+    "pin_memory": True,
+    "n_workers": None,
+    "threads_per_worker": 1,
     "output": "output.h5ad",
-    "output_model": None
+    "output_model": None,
+    "cache_dir": None
 }
 meta = {
     "resources_dir": "src/methods/lgc_ensemble",
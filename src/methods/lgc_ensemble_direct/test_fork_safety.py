@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+## VIASH START
+meta = {
+    "resources_dir": "src/methods/lgc_ensemble_helpers"
+}
+## VIASH END
+
+# train_grid forks its workers after the ChemBERTa features were computed in the same process.
+# Run it with threads_per_worker=2 after a multithreaded matmul in the parent, with the training
+# task replaced by multithreaded torch work. This deadlocks if the workers are not fork-safe,
+# so it runs in a subprocess with a timeout.
+check = f"""
+import sys
+sys.path.append({meta["resources_dir"]!r})
+import tempfile
+import torch
+import scheduler
+
+torch.set_num_threads(2)
+x = torch.randn(512, 512)
+(x @ x).sum()
+
+def fake_train_task(task):
+    y = torch.randn(512, 512)
+    for _ in range(5):
+        y = (y @ y).tanh()
+    _, _, _, scheme, model_name, fold = task
+    return scheme, model_name, fold, 0.0
+
+scheduler._train_task = fake_train_task
+out_dir = tempfile.mkdtemp()
+scheduler.train_grid(
+    out_dir, f"{{out_dir}}/models", f"{{out_dir}}/logs",
+    schemes=["initial"], models=["LSTM", "GRU"], kf_n_splits=2,
+    n_workers=2, threads_per_worker=2, pin_cores=False
+)
+"""
+
+print(">> Running train_grid with threads_per_worker=2 after a multithreaded parent", flush=True)
+try:
+    out = subprocess.run([sys.executable, "-c", check], timeout=300)
+except subprocess.TimeoutExpired:
+    raise AssertionError("train_grid did not finish, its workers deadlocked after forking")
+assert out.returncode == 0, f"train_grid exited with an error ({out.returncode})"
+
+print("All checks succeeded!", flush=True)
@@ -27,3 +27,32 @@ class Dataset:
             return self.data_x[idx], self.data_y[idx]
         else:
             return self.data_x[idx]
+
+
+class TensorBatchIterator:
+    """In-process replacement of a DataLoader for tensors that are already materialized in memory.
+    Every epoch draws a new index permutation (if shuffle), gathers the rows once into a reusable
+    (optionally pinned) buffer and yields contiguous slices of it as batches."""
+    def __init__(self, data_x, data_y=None, batch_size=16, shuffle=False, pin_memory=False):
+        self.tensors = [data for data in (data_x, data_y) if data is not None]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        if self.shuffle:
+            self.buffers = [torch.empty_like(data, pin_memory=self.pin_memory) for data in self.tensors]
+        elif self.pin_memory:
+            self.tensors = [data.pin_memory() for data in self.tensors]
+
+    def __len__(self):
+        return (len(self.tensors[0]) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            permutation = torch.randperm(len(self.tensors[0]))
+            for data, buffer in zip(self.tensors, self.buffers):
+                torch.index_select(data, 0, permutation, out=buffer)
+            tensors = self.buffers
+        for start in range(0, len(tensors[0]), self.batch_size):
+            batch = tuple(data[start:start + self.batch_size] for data in tensors)
+            yield batch if len(batch) > 1 else batch[0]
@@ -2,9 +2,9 @@ import os
 import json
 import time
 import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
 from torch.nn.utils import clip_grad_norm_
 from tqdm import tqdm
 from sklearn.preprocessing import OneHotEncoder
@@ -12,7 +12,7 @@ from transformers import AutoModelForMaskedLM, AutoTokenizer
 import random
 from sklearn.model_selection import KFold as KF
 from models import Conv, LSTM, GRU
-from helper_classes import Dataset
+from helper_classes import TensorBatchIterator
 from divisor_finder import find_balanced_divisors
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -55,27 +55,67 @@ def pad_to_balanced_shape(x, target_shape):
         padded = x
     return padded    
         
-def build_ChemBERTa_features(smiles_list):
-    chemberta = AutoModelForMaskedLM.from_pretrained("DeepChem/ChemBERTa-77M-MTR")
-    tokenizer = AutoTokenizer.from_pretrained("DeepChem/ChemBERTa-77M-MTR")
-    chemberta.eval()
-    embeddings = torch.zeros(len(smiles_list), 600)
-    embeddings_mean = torch.zeros(len(smiles_list), 600)
-    with torch.no_grad():
-        for i, smiles in enumerate(tqdm(smiles_list)):
-            encoded_input = tokenizer(smiles, return_tensors="pt", padding=False, truncation=True)
-            model_output = chemberta(**encoded_input)
-            embedding = model_output[0][::,0,::]
-            embeddings[i] = embedding
-            embedding = torch.mean(model_output[0], 1)
-            embeddings_mean[i] = embedding
-    return embeddings.numpy(), embeddings_mean.numpy()
+CHEMBERTA_MODEL = "DeepChem/ChemBERTa-77M-MTR"
+# in-memory embedding cache (smiles -> (embedding, mean embedding)), shared between the train and test featurization
+_chemberta_cache = {}
+
+def _chemberta_cache_path(cache_dir):
+    return f"{cache_dir}/{CHEMBERTA_MODEL.replace('/', '_')}.npz"
+
+def _load_ChemBERTa_cache(cache_dir):
+    if cache_dir is None or not os.path.exists(_chemberta_cache_path(cache_dir)):
+        return
+    with np.load(_chemberta_cache_path(cache_dir)) as cached:
+        for smiles, emb, emb_mean in zip(cached["smiles"], cached["embeddings"], cached["embeddings_mean"]):
+            _chemberta_cache.setdefault(str(smiles), (emb, emb_mean))
+
+def _save_ChemBERTa_cache(cache_dir):
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    smiles = sorted(_chemberta_cache)
+    def save_function(path):
+        with open(path, "wb") as file:
+            np.savez(file,
+                     smiles=np.array(smiles),
+                     embeddings=np.stack([_chemberta_cache[s][0] for s in smiles]),
+                     embeddings_mean=np.stack([_chemberta_cache[s][1] for s in smiles]))
+    save_atomic(save_function, _chemberta_cache_path(cache_dir))
+
+def build_ChemBERTa_features(smiles_list, cache_dir=None, batch_size=64):
+    """
+    Compute the ChemBERTa embedding (first token) and mean embedding of every SMILES. Only the unique SMILES that are not in the
+    (optionally persistent) embedding cache are encoded, in padded batches; the rows are then gathered from the cache.
+    The cache is keyed by the exact SMILES string, since that is what the tokenizer sees.
+    """
+    unique_smiles, inverse = np.unique(np.asarray(smiles_list, dtype=str), return_inverse=True)
+    _load_ChemBERTa_cache(cache_dir)
+    missing = [smiles for smiles in unique_smiles.tolist() if smiles not in _chemberta_cache]
+    if len(missing) > 0:
+        chemberta = AutoModelForMaskedLM.from_pretrained(CHEMBERTA_MODEL)
+        tokenizer = AutoTokenizer.from_pretrained(CHEMBERTA_MODEL)
+        chemberta.eval()
+        with torch.no_grad():
+            for start in tqdm(range(0, len(missing), batch_size)):
+                batch = missing[start:start+batch_size]
+                encoded_input = tokenizer(batch, return_tensors="pt", padding=True, truncation=True)
+                model_output = chemberta(**encoded_input)
+                embeddings = model_output[0][::,0,::]
+                # average over the actual tokens only, so padding does not change the mean embedding
+                mask = encoded_input["attention_mask"].unsqueeze(-1).to(model_output[0].dtype)
+                embeddings_mean = (model_output[0]*mask).sum(1) / mask.sum(1)
+                for smiles, emb, emb_mean in zip(batch, embeddings.numpy(), embeddings_mean.numpy()):
+                    _chemberta_cache[smiles] = (emb, emb_mean)
+        _save_ChemBERTa_cache(cache_dir)
+    embeddings = np.stack([_chemberta_cache[smiles][0] for smiles in unique_smiles])[inverse]
+    embeddings_mean = np.stack([_chemberta_cache[smiles][1] for smiles in unique_smiles])[inverse]
+    return embeddings, embeddings_mean
 
 
-def save_ChemBERTa_features(smiles_list, out_dir, on_train_data=False):
+def save_ChemBERTa_features(smiles_list, out_dir, on_train_data=False, cache_dir=None):
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    emb, emb_mean = build_ChemBERTa_features(smiles_list)
+    emb, emb_mean = build_ChemBERTa_features(smiles_list, cache_dir=cache_dir)
     if on_train_data:
         np.save(f"{out_dir}/chemberta_train.npy", emb)
         np.save(f"{out_dir}/chemberta_train_mean.npy", emb_mean)
@@ -84,44 +124,156 @@ def save_ChemBERTa_features(smiles_list, out_dir, on_train_data=False):
         np.save(f"{out_dir}/chemberta_test_mean.npy", emb_mean)                
     return emb, emb_mean
                 
+def _category_codes(keys, categories, column):
+    """Map each key onto the row position of the matching category in an augmentation table"""
+    codes = pd.Index(categories).get_indexer(keys)
+    if (codes < 0).any():
+        missing = sorted(set(np.asarray(keys)[codes < 0]))
+        raise ValueError(f"No '{column}' rows found in augmentation table for: {missing}")
+    return codes
+
 def combine_features(data_aug_dfs, chem_feats, main_df, one_hot_dfs=None, quantiles_df=None):
     """
     This function concatenates the provided vectors, matrices and data frames (i.e., one hot, std, mean, etc) into a single long vector. This is done for each input pair (cell_type, sm_name)
+
+    Categories are turned into integer codes once, the matching table rows are gathered with np.take and
+    written into a single preallocated (zero padded) output array.
     """
-    new_vecs = []
+    n_rows = len(main_df)
     chem_feat_dim = 600
-    if len(data_aug_dfs) > 0:
-        add_len = sum(aug_df.shape[1]-1 for aug_df in data_aug_dfs)+chem_feat_dim*len(chem_feats)+one_hot_dfs.shape[1] if\
-        one_hot_dfs is not None else sum(aug_df.shape[1]-1 for aug_df in data_aug_dfs)+chem_feat_dim*len(chem_feats)
-    else:
-        add_len = chem_feat_dim*len(chem_feats)+one_hot_dfs.shape[1] if\
-        one_hot_dfs is not None else chem_feat_dim*len(chem_feats)
+    # (values, row codes) for every block in the order they are concatenated, codes is None for row-aligned blocks
+    blocks = []
+    if one_hot_dfs is not None:
+        blocks.append((np.asarray(one_hot_dfs, dtype=float), None))
+    for df in data_aug_dfs:
+        column = 'cell_type' if 'cell_type' in df.columns else 'sm_name'
+        assert column in df.columns
+        codes = _category_codes(main_df[column].values, df[column].values, column)
+        blocks.append((df.iloc[:, 1:].to_numpy(dtype=float), codes))
+    for chem_feat in chem_feats:
+        blocks.append((np.asarray(chem_feat, dtype=float), None))
+
+    add_len = sum(aug_df.shape[1]-1 for aug_df in data_aug_dfs)+chem_feat_dim*len(chem_feats)
+    if one_hot_dfs is not None:
+        add_len += one_hot_dfs.shape[1]
     if quantiles_df is not None:
         add_len += (quantiles_df.shape[1]-1)//3
-    for i in range(len(main_df)):
-        if one_hot_dfs is not None:
-            vec_ = (one_hot_dfs.iloc[i,:].values).copy()
+    _, input_shape = find_balanced_divisors(add_len)
+    out_len = max(add_len, input_shape[0]*input_shape[1])
+
+    new_final_vec = np.zeros((n_rows, 1, out_len), dtype=float)
+    offset = 0
+    for values, codes in blocks:
+        width = values.shape[1]
+        dest = new_final_vec[:, 0, offset:offset+width]
+        if codes is None:
+            dest[...] = values[:n_rows]
         else:
-            vec_ = np.array([])
-        for df in data_aug_dfs:
-            if 'cell_type' in df.columns:
-                values = df[df['cell_type']==main_df.iloc[i]['cell_type']].values.squeeze()[1:].astype(float)
-                vec_ = np.concatenate([vec_, values])
-            else:
-                assert 'sm_name' in df.columns
-                values = df[df['sm_name']==main_df.iloc[i]['sm_name']].values.squeeze()[1:].astype(float)
-                vec_ = np.concatenate([vec_, values])
-        for chem_feat in chem_feats:
-            vec_ = np.concatenate([vec_, chem_feat[i]])
-        final_vec = np.concatenate([vec_,np.zeros(add_len-vec_.shape[0],)])
-        new_vecs.append(final_vec)
-
-    new_final_vec = np.stack(new_vecs, axis=0).astype(float).reshape(len(main_df), 1, add_len)
-    _, input_shape = find_balanced_divisors(new_final_vec.shape[-1])
-    if input_shape[0]*input_shape[1] != new_final_vec.shape[-1]:
-        new_final_vec = pad_to_balanced_shape(new_final_vec, (input_shape[0], input_shape[1]))
+            np.take(values, codes, axis=0, out=dest, mode='clip')
+        offset += width
     return new_final_vec
 
+#### Feature store
+FEATURE_STORE_VERSION = 2
+TEST_INDEX_COLUMNS = ["cell_type", "sm_name"]
+
+def save_feature_store(out_dir, tables, test_features, id_map):
+    """
+    Store the data augmentation tables (i.e., mean_cell_type, quantiles_cell_type, etc) and the test-time feature tensors of each scheme as .npy files,
+    together with an index.json holding the category index of every table and the (cell_type, sm_name) pair of every test row.
+    The tables are expected to have the category in their first column, the test rows to be in the order of id_map.
+    """
+    store_dir = f"{out_dir}/feature_store"
+    os.makedirs(store_dir, exist_ok=True)
+    index = {
+        "version": FEATURE_STORE_VERSION,
+        "tables": {},
+        "test_features": {},
+        "test_index": {col: id_map[col].astype(str).tolist() for col in TEST_INDEX_COLUMNS}
+    }
+    for name, df in tables.items():
+        column = df.columns[0]
+        np.save(f"{store_dir}/{name}.npy", df.iloc[:, 1:].to_numpy(dtype=float))
+        index["tables"][name] = {"column": column, "categories": df[column].tolist(), "file": f"{name}.npy"}
+    for scheme, features in test_features.items():
+        # the models consume float32 tensors, so storing float64 would only double the I/O
+        np.save(f"{store_dir}/test_vec_{scheme}.npy", features.astype(np.float32))
+        index["test_features"][scheme] = f"test_vec_{scheme}.npy"
+    with open(f"{store_dir}/index.json", "w") as file:
+        json.dump(index, file)
+
+def load_feature_store(out_dir, mmap_mode="c", id_map=None):
+    """
+    Load a feature store written by save_feature_store. All arrays are memory-mapped (copy-on-write) by default.
+    If id_map is given, a ValueError is raised unless its (cell_type, sm_name) pairs match the test rows of the store, row by row.
+    Returns the tables as data frames (category in the first column) and the test-time feature tensors per scheme.
+    """
+    store_dir = f"{out_dir}/feature_store"
+    with open(f"{store_dir}/index.json", "r") as file:
+        index = json.load(file)
+    if index["version"] != FEATURE_STORE_VERSION:
+        raise ValueError(f"Unsupported feature store version {index['version']}, expected {FEATURE_STORE_VERSION}")
+    if id_map is not None:
+        check_test_index(index["test_index"], id_map)
+    tables = {}
+    for name, info in index["tables"].items():
+        table = pd.DataFrame(np.load(f"{store_dir}/{info['file']}", mmap_mode=mmap_mode))
+        table.insert(0, info["column"], info["categories"])
+        tables[name] = table
+    test_features = {
+        scheme: np.load(f"{store_dir}/{file}", mmap_mode=mmap_mode)
+        for scheme, file in index["test_features"].items()
+    }
+    return tables, test_features
+
+def check_test_index(test_index, id_map):
+    """Raise a ValueError unless the (cell_type, sm_name) pairs of id_map equal those of the stored test rows, in the same order"""
+    stored = pd.DataFrame(test_index, columns=TEST_INDEX_COLUMNS)
+    current = id_map[TEST_INDEX_COLUMNS].astype(str).reset_index(drop=True)
+    if len(stored) != len(current):
+        raise ValueError(f"The feature store was prepared for {len(stored)} test rows, but id_map has {len(current)} rows")
+    mismatch = np.flatnonzero((stored != current).any(axis=1).to_numpy())
+    if len(mismatch):
+        row = mismatch[0]
+        raise ValueError(
+            f"The feature store was prepared for a different id_map: {len(mismatch)} rows differ, "
+            f"e.g. row {row} is {tuple(current.iloc[row])} in id_map but {tuple(stored.iloc[row])} in the feature store"
+        )
+
+def save_training_data(out_dir, X_vecs, y, cell_types_sm_names, config):
+    """
+    Store the training features of each scheme, the targets, the training config, the shapes and the cross-validation indices of each scheme
+    in out_dir, in the layout expected by train_fold.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    cell_types_sm_names.to_csv(f'{out_dir}/cell_types_sm_names.csv', index=False)
+    for scheme, X in X_vecs.items():
+        np.save(f'{out_dir}/X_vec_{scheme}.npy', X)
+    np.save(f'{out_dir}/y.npy', y)
+    with open(f'{out_dir}/config.json', 'w') as file:
+        json.dump(config, file)
+    shapes = {
+        "xshapes": {scheme: X.shape for scheme, X in X_vecs.items()},
+        "yshape": y.shape
+    }
+    with open(f'{out_dir}/shapes.json', 'w') as file:
+        json.dump(shapes, file)
+    kf_cv = KF(n_splits=config["KF_N_SPLITS"], shuffle=True, random_state=42)
+    for scheme, X in X_vecs.items():
+        kf_index = [(tr.astype(int).tolist(), va.astype(int).tolist()) for tr, va in kf_cv.split(X)]
+        with open(f'{out_dir}/kf_cv_{scheme}.json', 'w') as file:
+            json.dump(kf_index, file)
+
+def save_json(obj, path):
+    with open(path, 'w') as file:
+        json.dump(obj, file)
+
+def save_atomic(save_function, path):
+    """Write a file through save_function(tmp_path) and move it into place, so readers never see a partially written file"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_function(tmp_path)
+    os.replace(tmp_path, path)
+
 def augment_data(x_, y_):
     copy_x = x_.copy()
     new_x = []
@@ -138,45 +290,52 @@ def augment_data(x_, y_):
 def mrrmse_np(y_pred, y_true):
     return np.sqrt(np.square(y_true - y_pred).mean(axis=1)).mean()
 
+def mrrmse_torch(y_pred, y_true):
+    return torch.sqrt(torch.square(y_true - y_pred).mean(dim=1)).mean()
+
 
 #### Training utilities
 def train_step(dataloader, model, opt, clip_norm):
     model.train()
-    train_losses = []
-    train_mrrmse = []
+    model.to(device)
+    # losses and metrics are accumulated on the device to avoid a host sync per batch
+    train_loss = torch.zeros((), device=device)
+    train_mrrmse = torch.zeros((), device=device)
+    n_batches = 0
     for x, target in dataloader:
-        model.to(device)
         x = x.to(device)
         target = target.to(device)
-        loss = model(x, target)
+        loss, pred = model(x, target, return_pred=True)
         # aggregate loss if it's not a scalar
         if len(loss.size()) > 0:
             loss = loss.mean()
-        train_losses.append(loss.item())
-        pred = model(x).detach().cpu().numpy()
-        train_mrrmse.append(mrrmse_np(pred, target.cpu().numpy()))
+        train_loss += loss.detach()
+        train_mrrmse += mrrmse_torch(pred.detach(), target)
+        n_batches += 1
         opt.zero_grad()
         loss.backward()
         clip_grad_norm_(model.parameters(), clip_norm)
         opt.step()
-    return np.mean(train_losses), np.mean(train_mrrmse)
+    return (train_loss / n_batches).item(), (train_mrrmse / n_batches).item()
 
 def validation_step(dataloader, model):
     model.eval()
-    val_losses = []
-    val_mrrmse = []
-    for x, target in dataloader:
-        model.to(device)
-        x = x.to(device)
-        target = target.to(device)
-        loss = model(x,target)
-        # aggregate loss if it's not a scalar
-        if len(loss.size()) > 0:
-            loss = loss.mean()
-        pred = model(x).detach().cpu().numpy()
-        val_mrrmse.append(mrrmse_np(pred, target.cpu().numpy()))
-        val_losses.append(loss.item())
-    return np.mean(val_losses), np.mean(val_mrrmse)
+    model.to(device)
+    val_loss = torch.zeros((), device=device)
+    val_mrrmse = torch.zeros((), device=device)
+    n_batches = 0
+    with torch.no_grad():
+        for x, target in dataloader:
+            x = x.to(device)
+            target = target.to(device)
+            loss, pred = model(x, target, return_pred=True)
+            # aggregate loss if it's not a scalar
+            if len(loss.size()) > 0:
+                loss = loss.mean()
+            val_loss += loss
+            val_mrrmse += mrrmse_torch(pred, target)
+            n_batches += 1
+    return (val_loss / n_batches).item(), (val_mrrmse / n_batches).item()
 
 
 def train_function(model, model_name, x_train, y_train, x_val, y_val, info_data, config, clip_norm=1.0):
@@ -195,8 +354,10 @@ def train_function(model, model_name, x_train, y_train, x_val, y_val, info_data,
     data_y_train = torch.FloatTensor(y_train_aug)
     data_x_val = torch.FloatTensor(x_val)
     data_y_val = torch.FloatTensor(y_val)
-    train_dataloader = DataLoader(Dataset(data_x_train, data_y_train), num_workers=1, batch_size=16, shuffle=True, pin_memory=True, persistent_workers=True)
-    val_dataloader = DataLoader(Dataset(data_x_val, data_y_val), num_workers=1, batch_size=32, shuffle=False, pin_memory=True, persistent_workers=True)
+    batch_size = config.get("BATCH_SIZE", 16)
+    pin_memory = config.get("PIN_MEMORY", True)
+    train_dataloader = TensorBatchIterator(data_x_train, data_y_train, batch_size=batch_size, shuffle=True, pin_memory=pin_memory)
+    val_dataloader = TensorBatchIterator(data_x_val, data_y_val, batch_size=32, shuffle=False, pin_memory=pin_memory)
     best_loss = np.inf
     best_weights = None
     t0 = time.time()
@@ -218,6 +379,29 @@ def train_function(model, model_name, x_train, y_train, x_val, y_val, info_data,
     return model, results
 
 
+def train_fold(train_data_aug_dir, scheme, model_name, fold):
+    """Train one (scheme, model, fold) combination on the training data stored by save_training_data"""
+    with open(f'{train_data_aug_dir}/kf_cv_{scheme}.json', 'r') as file:
+        kf_cv = json.load(file)
+    train_idx, val_idx = kf_cv[fold]
+    X = np.load(f'{train_data_aug_dir}/X_vec_{scheme}.npy', mmap_mode='r')
+    y = np.load(f'{train_data_aug_dir}/y.npy', mmap_mode='r')
+    cell_types_sm_names = pd.read_csv(f'{train_data_aug_dir}/cell_types_sm_names.csv')
+    with open(f'{train_data_aug_dir}/config.json', 'r') as file:
+        config = json.load(file)
+
+    x_train, x_val = X[train_idx], X[val_idx]
+    y_train, y_val = y[train_idx], y[val_idx]
+    info_data = {
+        'train_cell_type': cell_types_sm_names.iloc[train_idx]['cell_type'].tolist(),
+        'val_cell_type': cell_types_sm_names.iloc[val_idx]['cell_type'].tolist(),
+        'train_sm_name': cell_types_sm_names.iloc[train_idx]['sm_name'].tolist(),
+        'val_sm_name': cell_types_sm_names.iloc[val_idx]['sm_name'].tolist()
+    }
+    clip_norm = config["CLIP_VALUES"][['initial', 'light', 'heavy'].index(scheme)]
+    model = model_classes[model_name](scheme, X.shape, y.shape)
+    return train_function(model, model.name, x_train, y_train, x_val, y_val, info_data, config=config, clip_norm=clip_norm)
+
 def cross_validate_models(X, y, kf_cv, cell_types_sm_names, paths, config=None, scheme='initial', clip_norm=1.0):
     trained_models = []
     for i,(train_idx,val_idx) in enumerate(kf_cv.split(X)):
@@ -268,36 +452,47 @@ def inference_pytorch(model, dataloader):
     if isinstance(model, dict):
         model = load_model(model)
     model.eval()
+    model.to(device)
     preds = []
-    for x in dataloader:
-        model.to(device)
-        x = x.to(device)
-        pred = model(x).detach().cpu().numpy()
-        preds.append(pred)
+    with torch.no_grad():
+        for x in dataloader:
+            x = x.to(device)
+            pred = model(x).cpu().numpy()
+            preds.append(pred)
     model.to('cpu')
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     return np.concatenate(preds, axis=0)
 
-def average_prediction(X_test, trained_models):
-    all_preds = []
-    test_dataloader = DataLoader(Dataset(torch.FloatTensor(X_test)), num_workers=4, batch_size=64, shuffle=False)
-    for i,model in enumerate(trained_models):
-        current_pred = inference_pytorch(model, test_dataloader)
-        all_preds.append(current_pred)
-    return np.stack(all_preds, axis=1).mean(axis=1)
-
-
-def weighted_average_prediction(X_test, trained_models, model_wise=[0.25, 0.35, 0.40], fold_wise=None):
-    all_preds = []
-    test_dataloader = DataLoader(Dataset(torch.FloatTensor(X_test)), num_workers=4, batch_size=64, shuffle=False)
-    for i,model in enumerate(trained_models):
-        current_pred = inference_pytorch(model, test_dataloader)
-        current_pred = model_wise[i%3]*current_pred
-        if fold_wise:
-            current_pred = fold_wise[i//3]*current_pred
-        all_preds.append(current_pred)
-    return np.stack(all_preds, axis=1).sum(axis=1)
+def predict_models(X_test, trained_models, batch_size=64):
+    """
+    Run every model once on X_test and cache the raw predictions, so that all averages and blends can be computed from them.
+    Lazy models (dicts) are loaded from disk once. Returns an array of shape (n_models, n_samples, n_targets)
+    """
+    test_dataloader = TensorBatchIterator(torch.as_tensor(np.asarray(X_test), dtype=torch.float32), batch_size=batch_size, shuffle=False)
+    return np.stack([inference_pytorch(model, test_dataloader) for model in trained_models], axis=0)
+
+def average_prediction(all_preds):
+    return all_preds.mean(axis=0)
+
+
+# the models in the order of the model_wise weights
+MODEL_NAMES = ["LSTM", "Conv", "GRU"]
+
+def weighted_average_prediction(all_preds, trained_models, model_wise=[0.25, 0.35, 0.40], fold_wise=None):
+    """
+    Weighted average of all_preds, the predictions of trained_models as returned by (lazy_)load_trained_models.
+    The weights are looked up by model name (model_wise, in the order of MODEL_NAMES) and fold (fold_wise),
+    and the model weights are rescaled to sum to one over the models that were trained, so any subset of models works.
+    """
+    names = [model["model_name"] if isinstance(model, dict) else model.name for model in trained_models]
+    folds = [model["fold"] if isinstance(model, dict) else model.fold for model in trained_models]
+    model_weights = {name: model_wise[MODEL_NAMES.index(name)] for name in set(names)}
+    total = sum(model_weights.values())
+    weights = np.array([model_weights[name] / total for name in names])
+    if fold_wise:
+        weights = weights * np.array([fold_wise[fold] for fold in folds])
+    return np.tensordot(weights, all_preds, axes=1)
 
 def load_trained_models(path, kf_n_splits=5):
     with open(f'{path}/shapes.json', 'r') as f:
@@ -312,6 +507,7 @@ def load_trained_models(path, kf_n_splits=5):
                 for weights_path in os.listdir(path):
                     if model.name in weights_path and scheme in weights_path and f'fold{fold}' in weights_path:
                         model.load_state_dict(torch.load(f'{path}/{weights_path}', map_location='cpu'))
+                        model.fold = fold
                         trained_models[scheme].append(model)
     return trained_models
 
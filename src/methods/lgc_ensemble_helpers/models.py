@@ -36,19 +36,19 @@ class Conv(nn.Module):
         self.loss3 = nn.L1Loss()
         self.loss4 = nn.BCELoss()
         
-    def forward(self, x, y=None):
+    def forward(self, x, y=None, return_pred=False):
+        out = self.conv_block(x)
+        out = self.head1(self.linear(out))
         if y is None:
-            out = self.conv_block(x)
-            out = self.head1(self.linear(out))
             return out
-        else:
-            out = self.conv_block(x)
-            out = self.head1(self.linear(out))
-            loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
-            yhat = torch.sigmoid(out)
-            yy = torch.sigmoid(y)
-            loss2 = self.loss4(yhat, yy)
-            return 0.8*loss1 + 0.2*loss2
+        loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
+        yhat = torch.sigmoid(out)
+        yy = torch.sigmoid(y)
+        loss2 = self.loss4(yhat, yy)
+        loss = 0.8*loss1 + 0.2*loss2
+        if return_pred:
+            return loss, out
+        return loss
 
 
 class LSTM(nn.Module):
@@ -83,25 +83,23 @@ class LSTM(nn.Module):
         self.loss3 = nn.L1Loss()
         self.loss4 = nn.BCELoss()
         
-    def forward(self, x, y=None):
+    def forward(self, x, y=None, return_pred=False):
         shape1, shape2 = self.input_shape
         x = x.reshape(x.shape[0],shape1,shape2)
+        out, (hn, cn) = self.lstm(x)
+        out = out.reshape(out.shape[0],-1)
+        out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
+        out = self.head1(self.linear(out))
         if y is None:
-            out, (hn, cn) = self.lstm(x)
-            out = out.reshape(out.shape[0],-1)
-            out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
-            out = self.head1(self.linear(out))
             return out
-        else:
-            out, (hn, cn) = self.lstm(x)
-            out = out.reshape(out.shape[0],-1)
-            out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
-            out = self.head1(self.linear(out))
-            loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
-            yhat = torch.sigmoid(out)
-            yy = torch.sigmoid(y)
-            loss2 = self.loss4(yhat, yy)
-            return 0.8*loss1 + 0.2*loss2
+        loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
+        yhat = torch.sigmoid(out)
+        yy = torch.sigmoid(y)
+        loss2 = self.loss4(yhat, yy)
+        loss = 0.8*loss1 + 0.2*loss2
+        if return_pred:
+            return loss, out
+        return loss
         
         
 class GRU(nn.Module):
@@ -136,22 +134,20 @@ class GRU(nn.Module):
         self.loss3 = nn.L1Loss()
         self.loss4 = nn.BCELoss()
         
-    def forward(self, x, y=None):
+    def forward(self, x, y=None, return_pred=False):
         shape1, shape2 = self.input_shape
         x = x.reshape(x.shape[0],shape1,shape2)
+        out, hn = self.gru(x)
+        out = out.reshape(out.shape[0],-1)
+        out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
+        out = self.head1(self.linear(out))
         if y is None:
-            out, hn = self.gru(x)
-            out = out.reshape(out.shape[0],-1)
-            out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
-            out = self.head1(self.linear(out))
             return out
-        else:
-            out, hn = self.gru(x)
-            out = out.reshape(out.shape[0],-1)
-            out = torch.cat([out, hn.reshape(hn.shape[1], -1)], dim=1)
-            out = self.head1(self.linear(out))
-            loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
-            yhat = torch.sigmoid(out)
-            yy = torch.sigmoid(y)
-            loss2 = self.loss4(yhat, yy)
-            return 0.8*loss1 + 0.2*loss2
+        loss1 = 0.4*self.loss1(out, y) + 0.3*self.loss2(out, y) + 0.3*self.loss3(out, y)
+        yhat = torch.sigmoid(out)
+        yy = torch.sigmoid(y)
+        loss2 = self.loss4(yhat, yy)
+        loss = 0.8*loss1 + 0.2*loss2
+        if return_pred:
+            return loss, out
+        return loss
@@ -2,7 +2,7 @@ import time
 import anndata as ad
 import pandas as pd
 import numpy as np
-from helper_functions import combine_features, load_trained_models, average_prediction, weighted_average_prediction
+from helper_functions import load_feature_store, load_trained_models, predict_models, average_prediction, weighted_average_prediction
 
 def read_data(par):
     de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
@@ -22,22 +22,11 @@ def predict(par, meta, paths):
     de_train_h5ad, id_map = read_data(par)
     gene_names = list(de_train_h5ad.var_names)
     
-    ## Build input features
-    mean_cell_type = pd.read_csv(f'{paths["train_data_aug_dir"]}/mean_cell_type.csv')
-    std_cell_type = pd.read_csv(f'{paths["train_data_aug_dir"]}/std_cell_type.csv')
-    mean_sm_name = pd.read_csv(f'{paths["train_data_aug_dir"]}/mean_sm_name.csv')
-    std_sm_name = pd.read_csv(f'{paths["train_data_aug_dir"]}/std_sm_name.csv')
-    quantiles_df = pd.read_csv(f'{paths["train_data_aug_dir"]}/quantiles_cell_type.csv')
-    test_chem_feat = np.load(f'{paths["train_data_aug_dir"]}/chemberta_test.npy')
-    test_chem_feat_mean = np.load(f'{paths["train_data_aug_dir"]}/chemberta_test_mean.npy')
-    one_hot_test = pd.DataFrame(np.load(f'{paths["train_data_aug_dir"]}/one_hot_test.npy'))
-    
-    test_vec = combine_features([mean_cell_type, std_cell_type, mean_sm_name, std_sm_name],\
-                [test_chem_feat, test_chem_feat_mean], id_map, one_hot_test)
-    test_vec_light = combine_features([mean_cell_type,mean_sm_name],\
-                    [test_chem_feat, test_chem_feat_mean], id_map, one_hot_test)
-    test_vec_heavy = combine_features([quantiles_df,mean_cell_type,mean_sm_name],\
-                    [test_chem_feat,test_chem_feat_mean], id_map, one_hot_test, quantiles_df)
+    ## Load input features
+    _, test_features = load_feature_store(paths["train_data_aug_dir"], id_map=id_map)
+    test_vec = test_features["initial"]
+    test_vec_light = test_features["light"]
+    test_vec_heavy = test_features["heavy"]
     
     ## Load trained models
     print("\nLoading trained models...")
@@ -49,19 +38,19 @@ def predict(par, meta, paths):
     t0 = time.time()
     if "light" in par["schemes"]:
         print("\nPredicting light models...")
-        pred1 = average_prediction(test_vec_light, trained_models['light'])
-        pred2 = weighted_average_prediction(test_vec_light, trained_models['light'],\
-                                            model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
+        all_preds = predict_models(test_vec_light, trained_models['light'])
+        pred1 = average_prediction(all_preds)
+        pred2 = weighted_average_prediction(all_preds, trained_models['light'], model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
     if "initial" in par["schemes"]:
         print("\nPredicting initial models...")
-        pred3 = average_prediction(test_vec, trained_models['initial'])
-        pred4 = weighted_average_prediction(test_vec, trained_models['initial'],\
-                                            model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
+        all_preds = predict_models(test_vec, trained_models['initial'])
+        pred3 = average_prediction(all_preds)
+        pred4 = weighted_average_prediction(all_preds, trained_models['initial'], model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
     if "heavy" in par["schemes"]:
         print("\nPredicting heavy models...")
-        pred5 = average_prediction(test_vec_heavy, trained_models['heavy'])
-        pred6 = weighted_average_prediction(test_vec_heavy, trained_models['heavy'],\
-                                        model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
+        all_preds = predict_models(test_vec_heavy, trained_models['heavy'])
+        pred5 = average_prediction(all_preds)
+        pred6 = weighted_average_prediction(all_preds, trained_models['heavy'], model_wise=test_config["MODEL_COEFS"], fold_wise=fold_weights)
     t1 = time.time()
     print("Prediction time: ", t1-t0, " seconds")
     print("\nEnsembling predictions and writing to file...")
@@ -1,8 +1,9 @@
 import os
 import pandas as pd
 import anndata as ad
-from helper_functions import seed_everything, one_hot_encode, save_ChemBERTa_features
+from helper_functions import seed_everything, one_hot_encode, save_ChemBERTa_features, combine_features, save_feature_store
 from anndata_to_dataframe import anndata_to_dataframe
+from group_statistics import group_statistics, group_statistics_frame, group_quantiles_frame
 
 def prepare_data(par, paths):
     seed_everything()
@@ -13,31 +14,38 @@ def prepare_data(par, paths):
     de_train = de_train.drop(columns=['split'])
     id_map = pd.read_csv(par["id_map"])
     ## Create data augmentation
-    de_cell_type = de_train.iloc[:, [0] + list(range(5, de_train.shape[1]))]
-    de_sm_name = de_train.iloc[:, [1] + list(range(5, de_train.shape[1]))]
-    mean_cell_type = de_cell_type.groupby('cell_type').mean().reset_index()
-    mean_sm_name = de_sm_name.groupby('sm_name').mean().reset_index()
-    std_cell_type = de_cell_type.groupby('cell_type').std().reset_index()
-    std_sm_name = de_sm_name.groupby('sm_name').std().reset_index()
+    gene_names = list(de_train_h5ad.var_names)
+    group_stats_dir = f'{par["cache_dir"]}/group_statistics' if par["cache_dir"] else None
+    chemberta_cache_dir = f'{par["cache_dir"]}/chemberta' if par["cache_dir"] else None
+    stats_cell_type = group_statistics(de_train[gene_names].values, de_train['cell_type'], quantiles=[0.25, 0.50, 0.75], cache_dir=group_stats_dir)
+    stats_sm_name = group_statistics(de_train[gene_names].values, de_train['sm_name'], cache_dir=group_stats_dir)
+    mean_cell_type = group_statistics_frame(stats_cell_type, 'mean', 'cell_type', gene_names)
+    mean_sm_name = group_statistics_frame(stats_sm_name, 'mean', 'sm_name', gene_names)
+    std_cell_type = group_statistics_frame(stats_cell_type, 'std', 'cell_type', gene_names)
+    std_sm_name = group_statistics_frame(stats_sm_name, 'std', 'sm_name', gene_names)
     std_sm_name = std_sm_name.fillna(0)
-    cell_types = de_cell_type.groupby('cell_type').quantile(0.1).reset_index()['cell_type'] # This is just to get cell types in the right order for the next line
-    quantiles_cell_type = pd.concat([pd.DataFrame(cell_types)]+[de_cell_type.groupby('cell_type')[col]\
-    .quantile([0.25, 0.50, 0.75], interpolation='linear').unstack().reset_index(drop=True) for col in list(de_train.columns)[5:]], axis=1)
+    quantiles_cell_type = group_quantiles_frame(stats_cell_type, 'cell_type', [0.25, 0.50, 0.75])
     ## Save data augmentation features
     print(paths["train_data_aug_dir"])
     if not os.path.exists(paths["train_data_aug_dir"]):
         os.makedirs(paths["train_data_aug_dir"], exist_ok=True)
 
-    mean_cell_type.to_csv(f'{paths["train_data_aug_dir"]}/mean_cell_type.csv', index=False)
-    std_cell_type.to_csv(f'{paths["train_data_aug_dir"]}/std_cell_type.csv', index=False)
-    mean_sm_name.to_csv(f'{paths["train_data_aug_dir"]}/mean_sm_name.csv', index=False)
-    std_sm_name.to_csv(f'{paths["train_data_aug_dir"]}/std_sm_name.csv', index=False)
-    quantiles_cell_type.to_csv(f'{paths["train_data_aug_dir"]}/quantiles_cell_type.csv', index=False)
     ## Create one hot encoding features
-    one_hot_encode(de_train[["cell_type", "sm_name"]], id_map[["cell_type", "sm_name"]], out_dir=paths["train_data_aug_dir"])
+    _, one_hot_test = one_hot_encode(de_train[["cell_type", "sm_name"]], id_map[["cell_type", "sm_name"]], out_dir=paths["train_data_aug_dir"])
+    one_hot_test = pd.DataFrame(one_hot_test)
     ## Prepare ChemBERTa features
-    save_ChemBERTa_features(de_train["SMILES"].tolist(), out_dir=paths["train_data_aug_dir"], on_train_data=True)
+    save_ChemBERTa_features(de_train["SMILES"].tolist(), out_dir=paths["train_data_aug_dir"], on_train_data=True, cache_dir=chemberta_cache_dir)
     sm_name2smiles = {smname:smiles for smname, smiles in zip(de_train['sm_name'], de_train['SMILES'])}
     test_smiles = list(map(sm_name2smiles.get, id_map['sm_name'].values))
-    save_ChemBERTa_features(test_smiles, out_dir=paths["train_data_aug_dir"], on_train_data=False)
+    test_chem_feat, test_chem_feat_mean = save_ChemBERTa_features(test_smiles, out_dir=paths["train_data_aug_dir"], on_train_data=False, cache_dir=chemberta_cache_dir)
+    ## Save data augmentation tables and test features
+    test_vec = combine_features([mean_cell_type, std_cell_type, mean_sm_name, std_sm_name],\
+                [test_chem_feat, test_chem_feat_mean], id_map, one_hot_test)
+    test_vec_light = combine_features([mean_cell_type,mean_sm_name],\
+                    [test_chem_feat, test_chem_feat_mean], id_map, one_hot_test)
+    test_vec_heavy = combine_features([quantiles_cell_type,mean_cell_type,mean_sm_name],\
+                    [test_chem_feat,test_chem_feat_mean], id_map, one_hot_test, quantiles_cell_type)
+    tables = {"mean_cell_type": mean_cell_type, "std_cell_type": std_cell_type, "mean_sm_name": mean_sm_name,
+              "std_sm_name": std_sm_name, "quantiles_cell_type": quantiles_cell_type}
+    save_feature_store(paths["train_data_aug_dir"], tables, {"initial": test_vec, "light": test_vec_light, "heavy": test_vec_heavy}, id_map)
     print("### Done.")
@@ -0,0 +1,48 @@
+import os
+import torch
+from helper_functions import seed_everything, train_fold, save_atomic, save_json
+from worker_pool import available_cores, fork_pool
+
+def _train_task(task):
+    train_data_aug_dir, model_dir, logs_dir, scheme, model_name, fold = task
+    # seed every task, so the result does not depend on which worker runs it or in which order
+    seed_everything()
+    model, results = train_fold(train_data_aug_dir, scheme, model_name, fold)
+    model.to('cpu')
+    save_atomic(lambda path: torch.save(model.state_dict(), path), f'{model_dir}/pytorch_{model_name}_{scheme}_fold{fold}.pt')
+    save_atomic(lambda path: save_json(results, path), f'{logs_dir}/{model_name}_{scheme}_fold{fold}.json')
+    return scheme, model_name, fold, results['runtime']
+
+def train_grid(train_data_aug_dir, model_dir, logs_dir, schemes, models, kf_n_splits, n_workers=None, threads_per_worker=1, pin_cores=True):
+    """
+    Train the full scheme x model x fold grid on the training data stored in train_data_aug_dir by save_training_data.
+    On CPU-only hosts, the grid is trained on a pool of n_workers processes (default: as many as fit on the available cores),
+    each running threads_per_worker torch threads and pinned to its own cores. With a GPU, the grid is trained sequentially.
+    Since forking is not safe after torch has run multithreaded, a single thread per worker is used unless this process
+    keeps torch at one thread.
+    Checkpoints and logs are written atomically to model_dir and logs_dir.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    os.makedirs(logs_dir, exist_ok=True)
+    tasks = [
+        (train_data_aug_dir, model_dir, logs_dir, scheme, model_name, fold)
+        for scheme in schemes
+        for fold in range(kf_n_splits)
+        for model_name in models
+    ]
+    n_workers = n_workers or max(1, len(available_cores()) // threads_per_worker)
+    n_workers = min(n_workers, len(tasks))
+
+    if torch.cuda.is_available() or n_workers == 1:
+        # CUDA cannot be used in forked workers, so train in-process
+        for task in tasks:
+            scheme, model_name, fold, runtime = _train_task(task)
+            print(f"Trained {model_name} {scheme} fold{fold} in {runtime:.1f} seconds", flush=True)
+        return
+
+    print(f"Training {len(tasks)} models on {n_workers} workers", flush=True)
+    # when torch already ran multithreaded in this process (e.g. the ChemBERTa features of
+    # lgc_ensemble_direct), the workers are limited to one thread, see fork_safe_threads
+    with fork_pool(n_workers, threads_per_worker, pin_cores) as pool:
+        for scheme, model_name, fold, runtime in pool.imap_unordered(_train_task, tasks):
+            print(f"Trained {model_name} {scheme} fold{fold} in {runtime:.1f} seconds", flush=True)
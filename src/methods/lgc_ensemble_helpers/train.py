@@ -1,7 +1,9 @@
+import shutil
 import anndata as ad
 import pandas as pd
 import numpy as np
-from helper_functions import combine_features, train_validate
+from helper_functions import combine_features, load_feature_store, save_training_data
+from scheduler import train_grid
 from anndata_to_dataframe import anndata_to_dataframe
 
 def train(par, paths):
@@ -10,6 +12,8 @@ def train(par, paths):
         "CLIP_VALUES": [5.0, 1.0, 1.0],
         "EPOCHS": par["epochs"],
         "KF_N_SPLITS": par["kf_n_splits"],
+        "BATCH_SIZE": par["batch_size"],
+        "PIN_MEMORY": par["pin_memory"],
     }
     print("\nRead data and build features...")
     de_train_h5ad = ad.read_h5ad(par["de_train_h5ad"])
@@ -18,11 +22,12 @@ def train(par, paths):
     ylist = ['cell_type','sm_name','sm_lincs_id','SMILES','control']
     one_hot_train = pd.DataFrame(np.load(f'{paths["train_data_aug_dir"]}/one_hot_train.npy'))
     y = de_train.drop(columns=ylist)
-    mean_cell_type = pd.read_csv(f'{paths["train_data_aug_dir"]}/mean_cell_type.csv')
-    std_cell_type = pd.read_csv(f'{paths["train_data_aug_dir"]}/std_cell_type.csv')
-    mean_sm_name = pd.read_csv(f'{paths["train_data_aug_dir"]}/mean_sm_name.csv')
-    std_sm_name = pd.read_csv(f'{paths["train_data_aug_dir"]}/std_sm_name.csv')
-    quantiles_df = pd.read_csv(f'{paths["train_data_aug_dir"]}/quantiles_cell_type.csv')
+    tables, _ = load_feature_store(paths["train_data_aug_dir"])
+    mean_cell_type = tables["mean_cell_type"]
+    std_cell_type = tables["std_cell_type"]
+    mean_sm_name = tables["mean_sm_name"]
+    std_sm_name = tables["std_sm_name"]
+    quantiles_df = tables["quantiles_cell_type"]
     train_chem_feat = np.load(f'{paths["train_data_aug_dir"]}/chemberta_train.npy')
     train_chem_feat_mean = np.load(f'{paths["train_data_aug_dir"]}/chemberta_train_mean.npy')
     X_vec = combine_features([mean_cell_type, std_cell_type, mean_sm_name, std_sm_name],\
@@ -45,6 +50,18 @@ def train(par, paths):
     print(f"de_train:{de_train.shape}")
     print(f"Y:{y.shape}")
     cell_types_sm_names = de_train[['cell_type', 'sm_name']]
+    X_vecs = {'initial': X_vec, 'light': X_vec_light, 'heavy': X_vec_heavy}
+    save_training_data(paths["train_data_aug_dir"], X_vecs, y.values, cell_types_sm_names, train_config)
     print("\nTraining starting...")
-    train_validate(X_vec, X_vec_light, X_vec_heavy, y, cell_types_sm_names, train_config, par, paths)
+    train_grid(
+        paths["train_data_aug_dir"],
+        paths["model_dir"],
+        paths["logs_dir"],
+        schemes=par["schemes"],
+        models=par["models"],
+        kf_n_splits=par["kf_n_splits"],
+        n_workers=par["n_workers"],
+        threads_per_worker=par["threads_per_worker"]
+    )
+    shutil.copy(f'{paths["train_data_aug_dir"]}/shapes.json', f'{paths["model_dir"]}/shapes.json')
     print("\nDone.")
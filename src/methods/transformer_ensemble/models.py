@@ -16,7 +16,7 @@ class CustomTransformer(nn.Module):
         # self.transformer = nn.Transformer(d_model=d_model, nhead=num_heads, num_encoder_layers=num_layers,
         #                                 dropout=0.1, device='cuda')
         self.transformer = nn.TransformerEncoder(
-            nn.TransformerEncoderLayer(d_model=d_model, nhead=num_heads, device='cuda', dropout=0.3,
+            nn.TransformerEncoderLayer(d_model=d_model, nhead=num_heads, dropout=0.3,
                                        activation=nn.GELU(),
                                        batch_first=True), enable_nested_tensor=True, num_layers=num_layers
         )
@@ -14,19 +14,34 @@ par = {
     "output_model": "output/model/",
     "num_train_epochs": 10,
     "early_stopping": 5000,
+    "early_stopping_smoothing": 0.0,
+    "validation_interval": 1,
+    "checkpoint_interval": 0,
+    "seed": None,
+    "num_threads": None,
+    "bf16_autocast": False,
+    "compile": False,
+    "cache_dir": None,
     "batch_size": 64,
     "d_model": 128,
     "layer": "sign_log10_pval"
 }
 meta = {
     "resources_dir": "src/methods/transformer_ensemble",
+    "temp_dir": "/tmp",
+    "cpus": None
 }
 ## VIASH END
 
 sys.path.append(meta["resources_dir"])
 
-from utils import prepare_augmented_data, prepare_augmented_data_mean_only
-from train import train_k_means_strategy, train_non_k_means_strategy
+from utils import prepare_features, select_features
+from train import train_k_means_strategy, train_non_k_means_strategy, autocast_context
+
+# limit the intra-op threads to the cpus assigned to the component
+num_threads = par["num_threads"] or meta.get("cpus")
+if num_threads:
+    torch.set_num_threads(num_threads)
 
 # create output model directory if need be
 if par["output_model"]:
@@ -80,30 +95,38 @@ argsets = [
 ]
 
 
+print(f"Prepare augmented data", flush=True)
+# the superset of the features of all argsets, each argset selects its columns from it
+features = prepare_features(
+    de_train_h5ad=de_train_h5ad,
+    id_map=id_map,
+    layer=par["layer"],
+    cache_dir=f"{par['cache_dir']}/group_statistics" if par["cache_dir"] else None,
+)
+
 predictions = []
 
 print(f"Train and predict models", flush=True)
 for i, argset in enumerate(argsets):
     print(f"Train and predict model {i+1}/{len(argsets)}", flush=True)
 
-    print(f"> Prepare augmented data", flush=True)
-    if argset["mean_std"] == "mean_std":
-        one_hot_encode_features, targets, one_hot_test = prepare_augmented_data(
-            de_train_h5ad=de_train_h5ad,
-            id_map=id_map,
-            layer=par["layer"],
-            uncommon=argset["uncommon"],
-        )
-    elif argset["mean_std"] == "mean":
-        one_hot_encode_features, targets, one_hot_test = prepare_augmented_data_mean_only(
-            de_train_h5ad=de_train_h5ad,
-            id_map=id_map,
-            layer=par["layer"],
-        )
-    else:
-        raise ValueError("Invalid mean_std argument")
+    print(f"> Select augmented data", flush=True)
+    one_hot_encode_features, targets, one_hot_test = select_features(
+        features,
+        mean_std=argset["mean_std"],
+        uncommon=argset["uncommon"],
+    )
 
     print(f"> Train model", flush=True)
+    train_kwargs = {
+        "validation_interval": par["validation_interval"],
+        "smoothing": par["early_stopping_smoothing"],
+        # a checkpoint per argset, which a rerun with the same output_model resumes from
+        "checkpoint_path": f"{par['output_model']}/checkpoint_{i}.pt" if par["output_model"] else None,
+        "checkpoint_interval": par["checkpoint_interval"],
+        "autocast": par["bf16_autocast"],
+        "compile_model": par["compile"],
+    }
     if argset["sampling_strategy"] == "k-means":
         label_reducer, scaler, transformer_model = train_k_means_strategy(
             n_components=n_components,
@@ -115,6 +138,7 @@ for i, argset in enumerate(argsets):
             batch_size=par["batch_size"],
             device=device,
             mean_std=argset["mean_std"],
+            **train_kwargs,
         )
     elif argset["sampling_strategy"] == "random":
         label_reducer, scaler, transformer_model = train_non_k_means_strategy(
@@ -127,6 +151,8 @@ for i, argset in enumerate(argsets):
             batch_size=par["batch_size"],
             device=device,
             mean_std=argset["mean_std"],
+            seed=par["seed"],
+            **train_kwargs,
         )
     else:
         raise ValueError("Invalid sampling_strategy argument")
@@ -144,9 +170,10 @@ for i, argset in enumerate(argsets):
     print(f"Predict on test data", flush=True)
     num_samples = len(unseen_data)
     transformed_data = []
-    for i in range(0, num_samples, par["batch_size"]):
-        batch_result = transformer_model(unseen_data[i : i + par["batch_size"]])
-        transformed_data.append(batch_result)
+    with torch.inference_mode(), autocast_context(device, par["bf16_autocast"]):
+        for start in range(0, num_samples, par["batch_size"]):
+            batch_result = transformer_model(unseen_data[start : start + par["batch_size"]])
+            transformed_data.append(batch_result.float())
     transformed_data = torch.vstack(transformed_data)
     if scaler:
         transformed_data = torch.tensor(
@@ -6,6 +6,8 @@ import torch.optim.lr_scheduler as lr_scheduler
 from sklearn.cluster import KMeans
 from sklearn.model_selection import train_test_split
 import copy
+import hashlib
+import os
 from torch.nn.utils import clip_grad_norm_
 from tqdm import tqdm
 
@@ -15,14 +17,20 @@ from models import CustomTransformer_mean_std, CustomTransformer_mean  # Can be
 from lion_pytorch import Lion
 from torch.utils.data import TensorDataset, DataLoader
 
-def train_epoch(model, dataloader, optimizer, criterion, device='cpu'):
+def autocast_context(device, enabled):
+    # bfloat16 autocast, which unlike float16 needs no loss scaling and is also supported on CPU
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def train_epoch(model, dataloader, optimizer, criterion, device='cpu', autocast=False):
     model.train()
     total_loss = 0.0
     for inputs, targets in dataloader:
         optimizer.zero_grad()
         inputs, targets = inputs.to(device), targets.to(device)
-        predictions = model(inputs)
-        loss = criterion(predictions, targets)
+        with autocast_context(device, autocast):
+            predictions = model(inputs)
+        loss = criterion(predictions.float(), targets)
         loss.backward()
         clip_grad_norm_(model.parameters(), max_norm=1.0)
         optimizer.step()
@@ -30,35 +38,64 @@ def train_epoch(model, dataloader, optimizer, criterion, device='cpu'):
     return total_loss / len(dataloader)
 
 
-def validate(model, val_dataloader, criterion, label_reducer=None, scaler=None, device='cpu'):
+def validate(model, val_dataloader, criterion, device='cpu', autocast=False):
+    # the targets of val_dataloader are in the space the model predicts in, i.e. reduced if a label reducer is used
     model.eval()
     val_loss = 0.0
     val_predictions_list = []
-    val_targets_list = []
     with torch.no_grad():
         for val_inputs, val_targets in val_dataloader:
-            val_targets_list.append(val_targets.clone().cpu())
             val_inputs, val_targets = val_inputs.to(device), val_targets.to(device)
-            val_predictions = model(val_inputs)
-            if label_reducer:
-                val_targets = torch.tensor(
-                    label_reducer.transform(scaler.transform(val_targets.clone().cpu().detach().numpy())),
-                    dtype=torch.float32).to(device)
+            with autocast_context(device, autocast):
+                val_predictions = model(val_inputs).float()
             val_loss += criterion(val_predictions, val_targets).item()
             val_predictions_list.append(val_predictions.cpu())
 
     val_loss /= len(val_dataloader)
 
     val_predictions_stacked = torch.cat(val_predictions_list, dim=0)
-    val_targets_stacked = torch.cat(val_targets_list, dim=0)
 
-    return val_loss, val_targets_stacked, val_predictions_stacked
+    return val_loss, val_predictions_stacked
+
+
+def data_fingerprint(*values):
+    # identifies the data and settings a checkpoint belongs to
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            digest.update(repr((value.shape, value.dtype.str)).encode())
+            digest.update(value.data)
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+def copy_state_dict(source, target):
+    # copy the weights in place, into a buffer allocated once
+    with torch.no_grad():
+        for key, value in source.items():
+            target[key].copy_(value)
 
 
 def train_func(X_train, Y_reduced, X_val, Y_val, n_components, num_epochs, batch_size, label_reducer, scaler,
-               d_model=128, early_stopping=5000, device='cpu', mean_std='mean_std'):
+               d_model=128, early_stopping=5000, device='cpu', mean_std='mean_std', validation_interval=1,
+               smoothing=0.0, checkpoint_path=None, checkpoint_interval=0, autocast=False, compile_model=False):
+    """
+    Train a transformer and return the weights with the lowest validation loss.
+
+    The model is validated every `validation_interval` epochs. Training stops once an exponential moving
+    average of the validation loss, with factor `smoothing`, has not improved for `early_stopping` epochs.
+    If `checkpoint_path` is given, a checkpoint is saved there every `checkpoint_interval` epochs, and an
+    existing checkpoint created for the same data and settings is resumed from.
+    If `autocast` is set, the forward passes run in bfloat16 autocast, and if `compile_model` is set,
+    they run through `torch.compile` when it is available.
+    """
+    if validation_interval < 1:
+        raise ValueError("validation_interval should be at least 1")
+    if not 0 <= smoothing < 1:
+        raise ValueError("smoothing should be in [0, 1)")
     best_mrrmse = float('inf')
-    best_model = None
     best_val_loss = float('inf')
     best_epoch = 0
     if mean_std == 'mean_std':
@@ -71,11 +108,21 @@ def train_func(X_train, Y_reduced, X_val, Y_val, n_components, num_epochs, batch
     dataset = TensorDataset(torch.tensor(X_train, dtype=torch.float32).to(device),
                             torch.tensor(Y_reduced, dtype=torch.float32).to(device))
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+
+    # reduce the validation targets once, instead of in every validation step
+    Y_val = np.asarray(Y_val, dtype=np.float32)
+    Y_val_reduced = label_reducer.transform(scaler.transform(Y_val)) if scaler else Y_val
     val_dataloader = DataLoader(TensorDataset(torch.tensor(X_val, dtype=torch.float32).to(device),
-                                              torch.tensor(
-                                                  Y_val,
-                                                  dtype=torch.float32).to(device)),
+                                              torch.tensor(Y_val_reduced, dtype=torch.float32).to(device)),
                                 batch_size=batch_size, shuffle=False)
+
+    # the compiled module shares its parameters with model, so the state dicts are taken from model
+    forward_model = model
+    if compile_model and hasattr(torch, 'compile'):
+        forward_model = torch.compile(model)
+
+    # buffer with the best weights so far
+    best_state = {key: value.detach().clone() for key, value in model.state_dict().items()}
     if n_components < X_train.shape[1]:
         lr = 1e-3
     else:
@@ -83,57 +130,127 @@ def train_func(X_train, Y_reduced, X_val, Y_val, n_components, num_epochs, batch
     # optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=1e-4)
     optimizer = Lion(model.parameters(), lr=lr, weight_decay=1e-4)
     # scheduler = lr_scheduler.CosineAnnealingLR(optimizer, T_max=10, eta_min=1e-7, verbose=False)
-    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer=optimizer, mode="min", factor=0.9999, patience=500,
-                                               verbose=True)
+    # with less frequent validation, the scheduler patience is counted in validations instead of epochs
+    scheduler = lr_scheduler.ReduceLROnPlateau(optimizer=optimizer, mode="min", factor=0.9999,
+                                               patience=max(1, 500 // validation_interval), verbose=True)
     criterion = nn.HuberLoss()
     # criterion = nn.L1Loss()
     # criterion = CustomLoss()
     # criterion = nn.MSELoss()
-    model.train()
+
+    # early stopping state, counter is the number of epochs without improvement of the smoothed loss
     counter = 0
-    pbar = tqdm(range(num_epochs), position=0, leave=True)
-    for epoch in range(num_epochs):
-        _ = train_epoch(model, dataloader, optimizer, criterion, device=device)
+    smoothed_val_loss = None
+    best_smoothed_val_loss = float('inf')
+    start_epoch = 0
+    finished = False
 
-        if counter >= early_stopping:
+    # everything that shapes the training trajectory, except the stopping criteria, which are re-evaluated on resume
+    fingerprint = data_fingerprint(X_train, Y_reduced, X_val, Y_val, n_components, d_model, mean_std, batch_size,
+                                   validation_interval, smoothing)
+    use_cuda_rng = torch.device(device).type == 'cuda'
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        if checkpoint['fingerprint'] != fingerprint:
+            print(f"Ignoring checkpoint {checkpoint_path}, it was created for different data or settings", flush=True)
+        else:
+            print(f"Resuming from checkpoint {checkpoint_path} at epoch {checkpoint['epoch']}", flush=True)
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            copy_state_dict(checkpoint['best_state'], best_state)
+            torch.set_rng_state(checkpoint['rng_state'])
+            if use_cuda_rng and checkpoint['cuda_rng_state'] is not None:
+                torch.cuda.set_rng_state_all(checkpoint['cuda_rng_state'])
+            start_epoch = checkpoint['epoch']
+            counter = checkpoint['counter']
+            smoothed_val_loss = checkpoint['smoothed_val_loss']
+            best_smoothed_val_loss = checkpoint['best_smoothed_val_loss']
+            best_val_loss = checkpoint['best_val_loss']
+            best_mrrmse = checkpoint['best_mrrmse']
+            best_epoch = checkpoint['best_epoch']
+            # a larger early_stopping continues a run that stopped early before
+            finished = counter >= early_stopping
+
+    def save_checkpoint(epoch):
+        # write to a temporary file first, so an interrupted save never corrupts the previous checkpoint
+        torch.save({
+            'fingerprint': fingerprint,
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'best_state': best_state,
+            'rng_state': torch.get_rng_state(),
+            'cuda_rng_state': torch.cuda.get_rng_state_all() if use_cuda_rng else None,
+            'counter': counter,
+            'smoothed_val_loss': smoothed_val_loss,
+            'best_smoothed_val_loss': best_smoothed_val_loss,
+            'best_val_loss': best_val_loss,
+            'best_mrrmse': float(best_mrrmse),
+            'best_epoch': best_epoch,
+        }, checkpoint_path + '.tmp')
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    model.train()
+    pbar = tqdm(total=num_epochs, initial=start_epoch, position=0, leave=True)
+    for epoch in range(start_epoch, num_epochs):
+        if finished:
             break
-        if scaler:
-            val_loss, val_targets_stacked, val_predictions_stacked = validate(model, val_dataloader, criterion,
-                                                                              label_reducer, scaler, device=device)
+        _ = train_epoch(forward_model, dataloader, optimizer, criterion, device=device, autocast=autocast)
+        pbar.update(1)
+
+        if (epoch + 1) % validation_interval == 0 or epoch + 1 == num_epochs:
+            val_loss, val_predictions_stacked = validate(forward_model, val_dataloader, criterion, device=device,
+                                                         autocast=autocast)
+            val_predictions = val_predictions_stacked.cpu().detach().numpy()
+            if scaler:
+                val_predictions = scaler.inverse_transform(label_reducer.inverse_transform(val_predictions))
             # Calculate MRRMSE for the entire validation set
-            val_mrrmse = calculate_mrrmse_np(
-                val_targets_stacked.cpu().detach().numpy(),
-                scaler.inverse_transform((label_reducer.inverse_transform(
-                    val_predictions_stacked.cpu().detach().numpy()))))
-        else:
-            val_loss, val_targets_stacked, val_predictions_stacked = validate(model, val_dataloader, criterion, device=device)
-            val_mrrmse = calculate_mrrmse_np(val_targets_stacked.cpu().detach().numpy(),
+            val_mrrmse = calculate_mrrmse_np(Y_val, val_predictions)
 
-                                             val_predictions_stacked.cpu().detach().numpy())
+            if val_mrrmse < best_mrrmse:
+                best_mrrmse = val_mrrmse
+                # best_model = copy.deepcopy(model)
 
-        if val_mrrmse < best_mrrmse:
-            best_mrrmse = val_mrrmse
-            # best_model = copy.deepcopy(model)
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                copy_state_dict(model.state_dict(), best_state)
+                best_epoch = epoch
 
-        if val_loss < best_val_loss:
-            best_val_loss = val_loss
-            best_model = copy.deepcopy(model)
-            counter = 0
-            best_epoch = epoch
-        else:
-            counter += 1
+            # stop on an exponential moving average of the loss, so a single noisy validation
+            # neither resets the patience nor triggers the stop
+            if smoothed_val_loss is None:
+                smoothed_val_loss = val_loss
+            else:
+                smoothed_val_loss = smoothing * smoothed_val_loss + (1 - smoothing) * val_loss
+            if smoothed_val_loss < best_smoothed_val_loss:
+                best_smoothed_val_loss = smoothed_val_loss
+                counter = 0
+            else:
+                counter += validation_interval
+            finished = counter >= early_stopping
 
-        pbar.set_description(
-            f"Validation best MRRMSE: {best_mrrmse:.4f} Validation best loss:"
-            f" {best_val_loss:.4f} Last epoch: {best_epoch}")
-        pbar.update(1)
-        # scheduler.step()  # for cosine anealing
-        scheduler.step(val_loss)
-    return label_reducer, scaler, best_model
+            pbar.set_description(
+                f"Validation best MRRMSE: {best_mrrmse:.4f} Validation best loss:"
+                f" {best_val_loss:.4f} Last epoch: {best_epoch}")
+            # scheduler.step()  # for cosine anealing
+            scheduler.step(val_loss)
+
+        if checkpoint_path and checkpoint_interval and (
+                (epoch + 1) % checkpoint_interval == 0 or finished or epoch + 1 == num_epochs):
+            save_checkpoint(epoch + 1)
+    pbar.close()
+
+    model.load_state_dict(best_state)
+    model.eval()
+    return label_reducer, scaler, model
 
 
 def train_transformer_k_means_learning(X, Y, n_components, num_epochs, batch_size,
-                                       d_model=128, early_stopping=5000, device='cpu', seed=18, mean_std='mean_std'):
+                                       d_model=128, early_stopping=5000, device='cpu', seed=18, mean_std='mean_std',
+                                       **train_kwargs):
     label_reducer, scaler, Y_reduced = reduce_labels(Y, n_components)
     Y_reduced = Y_reduced.to_numpy()
     Y = Y.to_numpy()
@@ -141,7 +258,8 @@ def train_transformer_k_means_learning(X, Y, n_components, num_epochs, batch_siz
     validation_percentage = 0.1
 
     # Create a K-Means clustering model
-    kmeans = KMeans(n_clusters=num_clusters, n_init=100)
+    # seeded, so the split is reproducible and a checkpoint can be resumed
+    kmeans = KMeans(n_clusters=num_clusters, n_init=100, random_state=seed)
 
     # Fit the model to your regression targets (Y)
     clusters = kmeans.fit_predict(Y)
@@ -171,11 +289,11 @@ def train_transformer_k_means_learning(X, Y, n_components, num_epochs, batch_siz
     X_train, Y_train = np.array(X_train), np.array(Y_train)
     X_val, Y_val = np.array(X_val), np.array(Y_val)
     return train_func(X_train, Y_train, X_val, Y_val, n_components, num_epochs, batch_size,
-                                   label_reducer, scaler, d_model, early_stopping, device, mean_std)
+                                   label_reducer, scaler, d_model, early_stopping, device, mean_std, **train_kwargs)
 
  
 def train_k_means_strategy(n_components, d_model, one_hot_encode_features, targets, num_epochs,
-                           early_stopping, batch_size, device, mean_std):
+                           early_stopping, batch_size, device, mean_std, **train_kwargs):
     # Training loop for k_means sampling strategy
     return train_transformer_k_means_learning(
         X=one_hot_encode_features,
@@ -186,12 +304,14 @@ def train_k_means_strategy(n_components, d_model, one_hot_encode_features, targe
         batch_size=batch_size,
         d_model=d_model,
         device=device,
-        mean_std=mean_std
+        mean_std=mean_std,
+        **train_kwargs
     )
 
 
 def train_non_k_means_strategy(n_components, d_model, one_hot_encode_features, targets, num_epochs,
-                               early_stopping, batch_size, device, mean_std, seed=None, validation_percentage=0.2):
+                               early_stopping, batch_size, device, mean_std, seed=None, validation_percentage=0.2,
+                               **train_kwargs):
     # Split the data for non-k_means sampling strategy
     X_train, X_val, y_train, y_val = split_data(
         one_hot_encode_features, targets, test_size=validation_percentage,
@@ -210,6 +330,7 @@ def train_non_k_means_strategy(n_components, d_model, one_hot_encode_features, t
         label_reducer=label_reducer,
         scaler=scaler,
         device=device,
-        mean_std=mean_std
+        mean_std=mean_std,
+        **train_kwargs
     )
 
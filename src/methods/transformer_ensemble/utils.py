@@ -7,6 +7,7 @@ import torch.optim
 from sklearn.preprocessing import StandardScaler
 import pickle
 from models import *
+from group_statistics import group_statistics
 
 
 def reduce_labels(Y, n_components):
@@ -21,157 +22,121 @@ def reduce_labels(Y, n_components):
     return label_reducer, scaler, Y_reduced
 
 
-def prepare_augmented_data(
-        de_train_h5ad,
-        id_map,
-        layer,
-        uncommon=False
-    ):
+def _category_codes(categories, values):
+    """Positions of values in the sorted categories"""
+    values = np.asarray(values).astype(str)
+    codes = np.minimum(np.searchsorted(categories, values), len(categories) - 1)
+    missing = categories[codes] != values
+    if missing.any():
+        raise ValueError(f"Categories not present in the training data: {sorted(set(values[missing]))}")
+    return codes
+
+
+def prepare_features(de_train_h5ad, id_map, layer, cache_dir=None):
+    """
+    Build the superset of the train and test features used by all argsets: the one-hot encoded
+    cell types and compounds, followed by the mean and std of the targets per cell type,
+    and then per compound. Use `select_features` to derive the features of an argset.
+
+    The statistics tables are computed once, and the rows are gathered by category code
+    into preallocated float32 arrays, with the same column order as joining the data frames.
+    """
     xlist = ['cell_type', 'sm_name']
+    statistics = ['mean', 'std']
     y = pd.DataFrame(
         de_train_h5ad.layers[layer],
         columns=de_train_h5ad.var_names,
         index=de_train_h5ad.obs.index
     )
+    n_train, n_test, n_genes = de_train_h5ad.n_obs, len(id_map), y.shape[1]
+
+    # One-hot encoding over the combined train and test categories, like pd.get_dummies
+    categories = {
+        col: np.unique(np.concatenate([
+            np.asarray(de_train_h5ad.obs[col]).astype(str),
+            np.asarray(id_map[col]).astype(str)
+        ]))
+        for col in xlist
+    }
+    n_one_hot = sum(len(categories[col]) for col in xlist)
+    n_features = n_one_hot + len(xlist) * len(statistics) * n_genes
+
+    X = np.zeros((n_train, n_features), dtype=np.float32)
+    test = np.zeros((n_test, n_features), dtype=np.float32)
+
+    offset = 0
+    for col in xlist:
+        X[np.arange(n_train), offset + _category_codes(categories[col], de_train_h5ad.obs[col])] = 1
+        test[np.arange(n_test), offset + _category_codes(categories[col], id_map[col])] = 1
+        offset += len(categories[col])
+
+    # Statistics of the targets per group, gathered by category code
+    blocks = {}
+    for col in xlist:
+        stats = group_statistics(y.values, de_train_h5ad.obs[col], cache_dir=cache_dir)
+        train_codes = _category_codes(stats['categories'], de_train_h5ad.obs[col])
+        test_codes = _category_codes(stats['categories'], id_map[col])
+        for statistic in statistics:
+            # std is NaN for groups with a single row, these get a std of 0
+            table = np.nan_to_num(stats[statistic], nan=0.0).astype(np.float32)
+            X[:, offset:offset + n_genes] = table[train_codes]
+            test[:, offset:offset + n_genes] = table[test_codes]
+            blocks[col, statistic] = np.arange(offset, offset + n_genes)
+            offset += n_genes
+
+    return {
+        "X": X,
+        "y": y,
+        "test": test,
+        "xlist": xlist,
+        "blocks": blocks,
+        # one-hot columns of categories which only occur in the training data
+        "uncommon": ~test[:, :n_one_hot].any(axis=0),
+    }
+
+
+def select_features(features, mean_std='mean_std', uncommon=False):
+    """
+    Derive the features of an argset from the output of `prepare_features`.
+    The full mean_std feature set is returned as is, the other argsets get a copy of their columns.
+
+    mean_std: 'mean_std' to keep the mean and std target encodings, 'mean' for the mean only
+    uncommon: whether to drop the one-hot columns of categories not present in the test data
+    """
+    if mean_std not in ['mean_std', 'mean']:
+        raise ValueError("Invalid mean_std argument")
+    statistics = ['mean', 'std'] if mean_std == 'mean_std' else ['mean']
+    if statistics == ['mean', 'std'] and not uncommon:
+        return features["X"], features["y"].copy(), features["test"]
+
+    one_hot = np.flatnonzero(~features["uncommon"]) if uncommon else np.arange(len(features["uncommon"]))
+    columns = np.concatenate([one_hot] + [
+        features["blocks"][col, statistic]
+        for col in features["xlist"]
+        for statistic in statistics
+    ])
+    return features["X"][:, columns], features["y"].copy(), features["test"][:, columns]
+
 
-    # Combine train and test data for one-hot encoding
-    combined_data = pd.concat([de_train_h5ad.obs[xlist], id_map[xlist]])
-
-    dum_data = pd.get_dummies(combined_data, columns=xlist)
-
-    # Split the combined data back into train and test
-    train = dum_data.iloc[:de_train_h5ad.n_obs]
-    test = dum_data.iloc[de_train_h5ad.n_obs:]
-    if uncommon:
-        uncommon = [f for f in train if f not in test]
-        X = train.drop(columns=uncommon)
-    X = train
-    
-    de_cell_type = pd.concat([de_train_h5ad.obs[['cell_type']], y], axis=1)
-    de_sm_name = pd.concat([de_train_h5ad.obs[['sm_name']], y], axis=1)
-
-    mean_cell_type = de_cell_type.groupby('cell_type').mean().reset_index()
-    std_cell_type = de_cell_type.groupby('cell_type').std().reset_index().fillna(0)
-
-    mean_sm_name = de_sm_name.groupby('sm_name').mean().reset_index()
-    std_sm_name = de_sm_name.groupby('sm_name').std().reset_index().fillna(0)
-
-    # Append mean and std for 'cell_type'
-    rows = []
-    for name in de_cell_type['cell_type']:
-        mean_rows = mean_cell_type[mean_cell_type['cell_type'] == name].copy()
-        std_rows = std_cell_type[std_cell_type['cell_type'] == name].copy()
-        rows.append(pd.concat([mean_rows, std_rows.add_suffix('_std')], axis=1))
-
-    tr_cell_type = pd.concat(rows)
-    tr_cell_type = tr_cell_type.reset_index(drop=True)
-
-    # Append mean and std for 'sm_name'
-    rows = []
-    for name in de_sm_name['sm_name']:
-        mean_rows = mean_sm_name[mean_sm_name['sm_name'] == name].copy()
-        std_rows = std_sm_name[std_sm_name['sm_name'] == name].copy()
-        rows.append(pd.concat([mean_rows, std_rows.add_suffix('_std')], axis=1))
-
-    tr_sm_name = pd.concat(rows)
-    tr_sm_name = tr_sm_name.reset_index(drop=True)
-
-    # Similar process for test data
-    rows = []
-    for name in id_map['cell_type']:
-        mean_rows = mean_cell_type[mean_cell_type['cell_type'] == name].copy()
-        std_rows = std_cell_type[std_cell_type['cell_type'] == name].copy()
-        rows.append(pd.concat([mean_rows, std_rows.add_suffix('_std')], axis=1))
-
-    te_cell_type = pd.concat(rows)
-    te_cell_type = te_cell_type.reset_index(drop=True)
-
-    rows = []
-    for name in id_map['sm_name']:
-        mean_rows = mean_sm_name[mean_sm_name['sm_name'] == name].copy()
-        std_rows = std_sm_name[std_sm_name['sm_name'] == name].copy()
-        rows.append(pd.concat([mean_rows, std_rows.add_suffix('_std')], axis=1))
-
-    te_sm_name = pd.concat(rows)
-    te_sm_name = te_sm_name.reset_index(drop=True)
-
-    # Join mean and std features to X0, test0
-    X0 = X.join(tr_cell_type.iloc[:, 1:]).copy()
-    X0 = X0.join(tr_sm_name.iloc[:, 1:], lsuffix='_cell_type', rsuffix='_sm_name')
-    # Remove string columns
-    X0 = X0.select_dtypes(exclude='object')
-
-    y0 = y.iloc[:, :].copy()
-
-    test0 = test.join(te_cell_type.iloc[:, 1:]).copy()
-    test0 = test0.join(te_sm_name.iloc[:, 1:], lsuffix='_cell_type', rsuffix='_sm_name')
-    # Remove string columns
-    test0 = test0.select_dtypes(exclude='object')
-    return X0.astype(np.float32).to_numpy(), y0, test0.astype(np.float32).to_numpy()
+def prepare_augmented_data(
+        de_train_h5ad,
+        id_map,
+        layer,
+        uncommon=False,
+        cache_dir=None
+    ):
+    features = prepare_features(de_train_h5ad, id_map, layer, cache_dir=cache_dir)
+    return select_features(features, 'mean_std', uncommon=uncommon)
 
 
 def prepare_augmented_data_mean_only(
         de_train_h5ad,
         layer,
-        id_map
+        id_map,
+        cache_dir=None
     ):
-    xlist = ['cell_type', 'sm_name']
-    y = pd.DataFrame(
-        de_train_h5ad.layers[layer],
-        columns=de_train_h5ad.var_names,
-        index=de_train_h5ad.obs.index
-    )
-    # Combine train and test data for one-hot encoding
-    combined_data = pd.concat([de_train_h5ad.obs[xlist], id_map[xlist]])
-
-    dum_data = pd.get_dummies(combined_data, columns=xlist)
-
-    # Split the combined data back into train and test
-    train = dum_data.iloc[:de_train_h5ad.n_obs]
-    test = dum_data.iloc[de_train_h5ad.n_obs:]
-    # uncommon = [f for f in train if f not in test]
-    # X = train.drop(columns=uncommon)
-
-    X = train
-    de_cell_type = pd.concat([de_train_h5ad.obs[['cell_type']], y], axis=1)
-    de_sm_name = pd.concat([de_train_h5ad.obs[['sm_name']], y], axis=1)
-    mean_cell_type = de_cell_type.groupby('cell_type').mean().reset_index()
-    mean_sm_name = de_sm_name.groupby('sm_name').mean().reset_index()
-    rows = []
-    for name in de_cell_type['cell_type']:
-        mean_rows = mean_cell_type[mean_cell_type['cell_type'] == name].copy()
-        rows.append(mean_rows)
-    tr_cell_type = pd.concat(rows)
-    tr_cell_type = tr_cell_type.reset_index(drop=True)
-
-    rows = []
-    for name in de_sm_name['sm_name']:
-        mean_rows = mean_sm_name[mean_sm_name['sm_name'] == name].copy()
-        rows.append(mean_rows)
-    tr_sm_name = pd.concat(rows)
-    tr_sm_name = tr_sm_name.reset_index(drop=True)
-
-    rows = []
-    for name in id_map['cell_type']:
-        mean_rows = mean_cell_type[mean_cell_type['cell_type'] == name].copy()
-        rows.append(mean_rows)
-
-    te_cell_type = pd.concat(rows)
-    te_cell_type = te_cell_type.reset_index(drop=True)
-    rows = []
-    for name in id_map['sm_name']:
-        mean_rows = mean_sm_name[mean_sm_name['sm_name'] == name].copy()
-        rows.append(mean_rows)
-
-    te_sm_name = pd.concat(rows)
-    te_sm_name = te_sm_name.reset_index(drop=True)
-    X0 = X.join(tr_cell_type.iloc[:, 1:]).copy()
-    X0 = X0.join(tr_sm_name.iloc[:, 1:], lsuffix='_cell_type', rsuffix='_sm_name')
-    y0 = y.iloc[:, :].copy()
-    test0 = test.join(te_cell_type.iloc[:, 1:]).copy()
-    test0 = test0.join(te_sm_name.iloc[:, 1:], lsuffix='_cell_type', rsuffix='_sm_name')
-    return X0.astype(np.float32).to_numpy(), y0, test0.astype(np.float32).to_numpy()
-
+    features = prepare_features(de_train_h5ad, id_map, layer, cache_dir=cache_dir)
+    return select_features(features, 'mean')
 
 
 def split_data(train_features, targets, test_size=0.3, shuffle=False, random_state=42):
@@ -1,10 +1,18 @@
+import os
+import multiprocessing as mp
 import anndata as ad
 import numpy as np
+import pandas as pd
 
 # VIASH START
 par = {
     "input": "resources/neurips-2023-raw/sc_counts_reannotated_with_counts.h5ad",
     "output": "output/sc_counts_bootstrapped_*.h5ad",
+    "num_replicates": 1,
+    "seed": None,
+    "output_format": "h5ad",
+    "compression": "gzip",
+    "n_workers": 1,
     "bootstrap_obs": True,
     "obs_fraction": 1,
     "obs_replace": True,
@@ -14,26 +22,65 @@ par = {
 }
 # VIASH END
 
-# Load data
-data = ad.read_h5ad(par["input"])
+def sample_indices(rng, n, fraction, replace):
+    return rng.choice(n, int(n * fraction), replace=replace)
 
-if par["bootstrap_obs"]:
-    # Sample indices
-    obs_ix = np.random.choice(
-        range(data.n_obs),
-        int(data.n_obs * par["obs_fraction"]),
-        replace=par["obs_replace"]
-    )
-    data = data[obs_ix, :]
-
-if par["bootstrap_var"]:
+def multiplicity_frame(names, ix):
+    """One row per sampled name, with the number of times it was sampled"""
+    counts = np.bincount(ix, minlength=len(names))
+    return pd.DataFrame({"multiplicity": counts[counts > 0]}, index=names[counts > 0])
+
+def write_replicate(task):
+    output, obs_ix, var_ix = task
+    data = _data
+    if par["output_format"] == "manifest":
+        # only store which obs and var were sampled and how often,
+        # downstream steps apply them to the input file
+        manifest = ad.AnnData(
+            obs=multiplicity_frame(data.obs_names, obs_ix),
+            var=multiplicity_frame(data.var_names, var_ix),
+            uns={"bootstrap_input": os.path.basename(par["input"])}
+        )
+        manifest.write_h5ad(output, compression="gzip")
+        return output
+    if par["bootstrap_obs"]:
+        data = data[obs_ix, :]
+    if par["bootstrap_var"]:
+        data = data[:, var_ix]
+    data.write_h5ad(output, compression=par["compression"])
+    return output
+
+# Load data, once for all replicates
+if par["output_format"] == "manifest":
+    _data = ad.read_h5ad(par["input"], backed="r")
+else:
+    _data = ad.read_h5ad(par["input"])
+
+# One independent random stream per replicate, so a replicate only depends on the seed and its index
+output_template = par["output"][0] if isinstance(par["output"], list) else par["output"]
+assert "*" in output_template or par["num_replicates"] == 1, \
+    "The output path needs a '*' placeholder for the replicate index when generating multiple replicates"
+seeds = np.random.SeedSequence(par["seed"]).spawn(par["num_replicates"])
+width = len(str(par["num_replicates"]))
+
+tasks = []
+for i, seed in enumerate(seeds):
+    rng = np.random.default_rng(seed)
     # Sample indices
-    var_ix = np.random.choice(
-        range(data.n_vars),
-        int(data.n_vars * par["var_fraction"]),
-        replace=par["var_replace"]
-    )
-    data = data[:, var_ix]
+    obs_ix = sample_indices(rng, _data.n_obs, par["obs_fraction"], par["obs_replace"]) \
+        if par["bootstrap_obs"] else np.arange(_data.n_obs)
+    var_ix = sample_indices(rng, _data.n_vars, par["var_fraction"], par["var_replace"]) \
+        if par["bootstrap_var"] else np.arange(_data.n_vars)
+    tasks.append((output_template.replace("*", str(i + 1).zfill(width)), obs_ix, var_ix))
 
 # Write output
-data.write_h5ad(par["output"], compression="gzip")
+# every worker materializes a full resampled copy of the input, so the default is a single worker
+n_workers = min(par["n_workers"], len(tasks))
+if n_workers > 1 and par["output_format"] == "h5ad":
+    # fork, so the workers share the loaded data instead of reading it again
+    with mp.get_context("fork").Pool(n_workers) as pool:
+        for output in pool.imap_unordered(write_replicate, tasks):
+            print(f"Wrote {output}", flush=True)
+else:
+    for task in tasks:
+        print(f"Wrote {write_replicate(task)}", flush=True)
@@ -1,52 +1,148 @@
 import anndata as ad
+import h5py
 import numpy as np
 import pandas as pd
 from scipy import sparse
 
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
 ## VIASH START
 par = {
     "input": "resources/neurips-2023-raw/sc_counts_reannotated_with_counts.h5ad",
     "output": "resources/neurips-2023-data/pseudobulk.h5ad",
+    "chunk_size": 100000,
+    "bootstrap_manifest": None,
 }
 ## VIASH END
 
-def sum_by(adata: ad.AnnData, col: str) -> ad.AnnData:
+def iter_row_chunks(elem, chunk_size: int):
+    """
+    Iterate over an on-disk matrix in chunks of `chunk_size` rows.
+
+    CSR matrices and dense arrays are read chunk by chunk, other encodings are read at once.
+    Yields `(start, end, chunk)` tuples.
+    """
+    encoding = elem.attrs.get("encoding-type")
+    if isinstance(elem, h5py.Dataset):
+        n_rows = elem.shape[0]
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            yield start, end, elem[start:end]
+    elif encoding == "csr_matrix":
+        n_rows, n_cols = elem.attrs["shape"]
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            indptr = elem["indptr"][start:end + 1]
+            chunk = sparse.csr_matrix(
+                (
+                    elem["data"][indptr[0]:indptr[-1]],
+                    elem["indices"][indptr[0]:indptr[-1]],
+                    indptr - indptr[0]
+                ),
+                shape=(end - start, n_cols),
+            )
+            yield start, end, chunk
+    else:
+        matrix = read_elem(elem)
+        yield 0, matrix.shape[0], matrix
+
+def sum_rows_by(elem, codes: np.ndarray, n_groups: int, chunk_size: int, weights: np.ndarray = None) -> sparse.csr_matrix:
+    """
+    Sum the rows of an on-disk matrix per group code, streaming over chunks of rows.
+
+    If `weights` is given, every row is counted as many times as its weight.
+    Only the `(n_groups, n_cols)` result is kept in memory, next to a single chunk of rows.
+    """
+    result = None
+    for start, end, chunk in iter_row_chunks(elem, chunk_size):
+        indicator = sparse.csr_matrix(
+            (
+                np.broadcast_to(True, end - start) if weights is None else weights[start:end].astype(chunk.dtype),
+                (codes[start:end], np.arange(end - start))
+            ),
+            shape=(n_groups, end - start),
+        )
+        summed = sparse.coo_matrix(indicator @ chunk)
+        if result is None:
+            result = np.zeros((n_groups, chunk.shape[1]), dtype=summed.dtype)
+        result[summed.row, summed.col] += summed.data
+    return sparse.csr_matrix(result)
+
+def remove_unused_categories(obs: pd.DataFrame) -> pd.DataFrame:
+    """Remove unused categories from all categorical columns, like subsetting an AnnData does"""
+    obs = obs.copy()
+    for col in obs.columns:
+        if isinstance(obs[col].dtypes, pd.CategoricalDtype):
+            obs[col] = obs[col].cat.remove_unused_categories()
+    return obs
+
+def one_to_one_columns(obs: pd.DataFrame, col: str) -> list:
+    """
+    Return the columns of `obs` whose value is determined by the value of `obs[col]`.
+
+    Every column is factorized once, after which each column is checked by counting
+    the unique (group, value) code pairs per group.
+    """
+    group_codes, groups = pd.factorize(obs[col], use_na_sentinel=False)
+    group_codes = group_codes.astype(np.int64)
+    columns = []
+    for other_col in obs.columns:
+        if other_col == col:
+            continue
+        other_codes, values = pd.factorize(obs[other_col], use_na_sentinel=False)
+        pairs = np.unique(group_codes * len(values) + other_codes)
+        if np.all(np.bincount(pairs // len(values), minlength=len(groups)) == 1):
+            columns.append(other_col)
+    return columns
+
+def grouped_obs(obs: pd.DataFrame, col: str) -> pd.DataFrame:
+    """
+    Return one row per unique value of `obs[col]`, in order of first appearance,
+    with the columns that have a one-to-one mapping with `obs[col]`.
+    """
+    group_codes, _ = pd.factorize(obs[col], use_na_sentinel=False)
+    _, first_rows = np.unique(group_codes, return_index=True)
+    return obs.iloc[np.sort(first_rows)][[col] + one_to_one_columns(obs, col)]
+
+def sum_by(obs: pd.DataFrame, var: pd.DataFrame, col: str, elems: dict, chunk_size: int, weights: np.ndarray = None) -> ad.AnnData:
     """
+    Sum the rows of the on-disk matrices in `elems` for each unique value in `obs[col]`.
+
+    `elems` maps "X" or a layer name to the corresponding h5py element.
+    If `weights` is given, every row is counted as many times as its weight,
+    and rows with weight zero are left out entirely.
+
     Adapted from this forum post:
     https://discourse.scverse.org/t/group-sum-rows-based-on-jobs-feature/371/4
     """
 
-    # assert pd.api.types.is_categorical_dtype(adata.obs[col])
-    assert isinstance(adata.obs[col].dtypes, pd.CategoricalDtype)
-
-    # sum `.X` entries for each unique value in `col`
-    cat = adata.obs[col].values
-    indicator = sparse.coo_matrix(
-        (
-            np.broadcast_to(True, adata.n_obs),
-            (cat.codes, np.arange(adata.n_obs))
-        ),
-        shape=(len(cat.categories), adata.n_obs),
-    )
+    assert isinstance(obs[col].dtypes, pd.CategoricalDtype)
+
+    # sum entries for each unique value in `col`
+    cat = obs[col].values
+    codes = cat.codes
+    if weights is not None:
+        # only the groups of rows that were drawn are kept, rows that were not drawn
+        # get an arbitrary valid code, since their weight is zero anyway
+        obs = remove_unused_categories(obs[weights > 0])
+        cat = pd.Categorical(cat, categories=obs[col].cat.categories)
+        codes = np.where(weights > 0, cat.codes, 0)
     sum_adata = ad.AnnData(
-        var=adata.var,
+        var=var,
         obs=pd.DataFrame(index=cat.categories),
     )
-    if adata.X is not None:
-        sum_adata.X = indicator @ adata.X
-    for layer in adata.layers:
-        sum_adata.layers[layer] = indicator @ adata.layers[layer]
+    for key, elem in elems.items():
+        summed = sum_rows_by(elem, codes, len(cat.categories), chunk_size, weights)
+        if key == "X":
+            sum_adata.X = summed
+        else:
+            sum_adata.layers[key] = summed
 
     # copy over `.obs` values that have a one-to-one-mapping with `.obs[col]`
-    obs_cols = list(set(adata.obs.columns) - set([col]))
-
-    one_to_one_mapped_obs_cols = []
-    nunique_in_col = adata.obs[col].nunique()
-    for other_col in obs_cols:
-        if len(adata.obs[[col, other_col]].drop_duplicates()) == nunique_in_col:
-            one_to_one_mapped_obs_cols.append(other_col)
-
-    joining_df = adata.obs[[col] + one_to_one_mapped_obs_cols].drop_duplicates().set_index(col)
+    joining_df = grouped_obs(obs, col).set_index(col)
     assert (sum_adata.obs.index == sum_adata.obs.join(joining_df).index).all()
     sum_adata.obs = sum_adata.obs.join(joining_df)
     sum_adata.obs.index.name = col
@@ -56,29 +152,54 @@ def sum_by(adata: ad.AnnData, col: str) -> ad.AnnData:
     return sum_adata
 
 
-print(">> Load dataset", flush=True)
-sc_counts = ad.read_h5ad(par["input"])
+print(">> Load dataset metadata", flush=True)
+# only obs and var are read into memory, the counts are streamed from disk
+sc_counts_file = h5py.File(par["input"], "r")
+obs = read_elem(sc_counts_file["obs"])
+var = read_elem(sc_counts_file["var"])
 
 print(">> Keep only raw counts", flush=True)
-sc_counts.X = sc_counts.raw.X
-del sc_counts.raw
+elems = {"X": sc_counts_file["raw/X"]}
+if "layers" in sc_counts_file:
+    elems.update(sc_counts_file["layers"].items())
 
 print(">> Fix splits after reannotation", flush=True)
-sc_counts.obs["cell_type_orig_updated"] = sc_counts.obs["cell_type_orig"].apply(lambda x: "T cells" if x.startswith("T ") else x)
-sc_counts.obs["sm_cell_type_orig"] = sc_counts.obs["sm_name"].astype(str) + "_" + sc_counts.obs["cell_type_orig_updated"].astype(str)
-mapping_to_split = sc_counts.obs.groupby("sm_cell_type_orig")["split"].apply(lambda x: x.unique()[0]).to_dict()
-sc_counts.obs["sm_cell_type"] = sc_counts.obs["sm_name"].astype(str) + "_" + sc_counts.obs["cell_type"].astype(str)
-sc_counts.obs["split"] = sc_counts.obs["sm_cell_type"].map(mapping_to_split)
-sc_counts.obs['control'] = sc_counts.obs['split'].eq("control")
+obs["cell_type_orig_updated"] = obs["cell_type_orig"].apply(lambda x: "T cells" if x.startswith("T ") else x)
+obs["sm_cell_type_orig"] = obs["sm_name"].astype(str) + "_" + obs["cell_type_orig_updated"].astype(str)
+mapping_to_split = obs.groupby("sm_cell_type_orig")["split"].apply(lambda x: x.unique()[0]).to_dict()
+obs["sm_cell_type"] = obs["sm_name"].astype(str) + "_" + obs["cell_type"].astype(str)
+obs["split"] = obs["sm_cell_type"].map(mapping_to_split)
+obs['control'] = obs['split'].eq("control")
+
+weights = None
+if par["bootstrap_manifest"]:
+    print(">> Apply bootstrap manifest", flush=True)
+    # a cell that was drawn k times counts k times in the pseudobulk, cells that were
+    # not drawn, or that were filtered out of the input since, are left out
+    manifest = ad.read_h5ad(par["bootstrap_manifest"])
+    weights = manifest.obs["multiplicity"].reindex(obs.index, fill_value=0).to_numpy()
+    var_ix = var.index.get_indexer(manifest.var_names)
+    assert (var_ix >= 0).all(), "The bootstrap manifest contains genes which are not in the input"
+    var_ix = np.repeat(var_ix, manifest.var["multiplicity"].to_numpy())
 
 print(">> Create pseudobulk dataset", flush=True)
-bulk_adata = sum_by(sc_counts, 'plate_well_celltype_reannotated')
+bulk_adata = sum_by(obs, var, 'plate_well_celltype_reannotated', elems, par["chunk_size"], weights)
 bulk_adata.obs = bulk_adata.obs.drop(columns=['plate_well_celltype_reannotated'])
+sc_counts_file.close()
+
+if weights is not None:
+    bulk_adata = bulk_adata[:, var_ix].copy()
+    obs = remove_unused_categories(obs.iloc[np.repeat(np.arange(len(obs)), weights)])
 
 print(">> Remove samples with no counts", flush=True)
-bulk_adata = bulk_adata[bulk_adata.X.todense().sum(axis=1) > 0]
+bulk_adata = bulk_adata[np.asarray(bulk_adata.X.sum(axis=1)).ravel() > 0]
+
+bulk_adata.uns["single_cell_obs"] = obs
 
-bulk_adata.uns["single_cell_obs"] = sc_counts.obs
+# cache the [cell_type, sm_name] table, which run_limma uses to set up the DE contrasts
+sm_cell_type_obs = grouped_obs(bulk_adata.obs, "sm_cell_type").reset_index(drop=True)
+sm_cell_type_obs.index = sm_cell_type_obs.index.astype(str)
+bulk_adata.uns["sm_cell_type_obs"] = sm_cell_type_obs
 
 print(">> Save dataset", flush=True)
 bulk_adata.write_h5ad(par["output"], compression="gzip")
\ No newline at end of file
@@ -16,3 +16,60 @@ def anndata_to_dataframe(adata, layer_name="clipped_sign_log10_pval"):
   )
 
   return pd.concat([metadata, data], axis=1).reset_index(drop=True)
+
+def anndata_to_parquet(
+  input_path,
+  output_path,
+  layer_name="clipped_sign_log10_pval",
+  add_id=False,
+  row_group_size=1024,
+  compression="snappy"
+):
+  """Write the same table as `anndata_to_dataframe` to a parquet file, without building it in memory.
+
+  The layer is read from the h5ad file in chunks of `row_group_size` rows, and every chunk is
+  written as one row group. If `add_id` is True, an "id" column with the row number is prepended.
+  Returns the metadata columns as a data frame.
+  """
+  import h5py
+  import numpy as np
+  import pandas as pd
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  try:
+    from anndata.io import read_elem
+  except ImportError:
+    from anndata.experimental import read_elem
+
+  metadata_cols = ['cell_type', 'sm_name', 'sm_lincs_id', 'SMILES', 'split', 'control']
+
+  with h5py.File(input_path, "r") as file:
+    obs = read_elem(file["obs"])
+    var_names = read_elem(file["var"]).index.astype(str)
+    layer = file["layers"][layer_name]
+    if not isinstance(layer, h5py.Dataset):
+      # sparse layers are read at once
+      layer = np.asarray(read_elem(layer).todense())
+
+    metadata = obs[metadata_cols].reset_index(drop=True)
+    for col in metadata.select_dtypes(include=["category"]).columns:
+      metadata[col] = metadata[col].astype(str)
+    if add_id:
+      metadata.insert(0, "id", np.arange(len(metadata)))
+
+    # fixed schema: the metadata columns followed by one column per gene
+    schema = pa.Schema.from_pandas(metadata, preserve_index=False)
+    value_type = pa.from_numpy_dtype(layer.dtype)
+    for name in var_names:
+      schema = schema.append(pa.field(name, value_type))
+
+    with pq.ParquetWriter(output_path, schema, compression=compression) as writer:
+      for start in range(0, len(metadata), row_group_size):
+        end = min(start + row_group_size, len(metadata))
+        meta_table = pa.Table.from_pandas(metadata.iloc[start:end], preserve_index=False)
+        # column-major, so every gene column is a contiguous array
+        values = np.asfortranarray(layer[start:end])
+        arrays = meta_table.columns + [pa.array(values[:, j]) for j in range(values.shape[1])]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=row_group_size)
+
+  return metadata
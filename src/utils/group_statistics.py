@@ -0,0 +1,115 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+# bumped whenever the cached statistics change
+_CACHE_VERSION = 2
+
+def _content_hash(values, groups, quantiles):
+  hasher = hashlib.sha1()
+  hasher.update(str((_CACHE_VERSION, values.shape, values.dtype.str, tuple(quantiles))).encode())
+  hasher.update(np.ascontiguousarray(values).data)
+  hasher.update("\0".join(map(str, groups)).encode())
+  return hasher.hexdigest()
+
+def _linear_quantiles(sorted_block, quantiles):
+  # same interpolation formula as pandas' groupby quantile, so results are identical
+  positions = np.asarray(quantiles) * (sorted_block.shape[0] - 1)
+  lower = np.floor(positions).astype(int)
+  upper = np.minimum(lower + 1, sorted_block.shape[0] - 1)
+  frac = (positions % 1)[:, None]
+  lower_values = sorted_block[lower]
+  return np.where(frac == 0, lower_values, lower_values + (sorted_block[upper] - lower_values) * frac)
+
+def compute_group_statistics(values, groups, quantiles=()):
+  """Compute the per-group count, mean, std and quantiles of every column in one pass.
+
+  The mean and std are computed by pandas' grouped aggregations, the quantiles on the
+  contiguous block of each group after sorting the rows by group code once.
+
+  Parameters:
+  values: array of shape (n_obs, n_features)
+  groups: array-like of length n_obs with the group label of every row
+  quantiles: quantiles to compute per group (linear interpolation, like pandas)
+
+  Returns:
+  dict with dense arrays indexed by category code:
+    categories: sorted group labels, shape (n_groups,)
+    count: shape (n_groups,)
+    mean, std: shape (n_groups, n_features), std uses ddof=1 and is NaN for singleton groups
+    quantiles: shape (n_groups, len(quantiles), n_features)
+  """
+  values = np.asarray(values, dtype=np.float64)
+  categories, codes = np.unique(np.asarray(groups).astype(str), return_inverse=True)
+
+  order = np.argsort(codes, kind="stable")
+  values_sorted = values[order]
+  count = np.bincount(codes, minlength=len(categories))
+  starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+
+  # pandas' grouped mean and std, so the summation order and thus every bit of the result
+  # equals `df.groupby(group).mean()` and `.std()`
+  grouped = pd.DataFrame(values, copy=False).groupby(codes, sort=True)
+  mean = grouped.mean().to_numpy()
+  std = grouped.std().to_numpy()
+
+  quantile_values = np.empty((len(categories), len(quantiles), values.shape[1]))
+  if len(quantiles) > 0:
+    for code, (start, size) in enumerate(zip(starts, count)):
+      block = np.sort(values_sorted[start:start + size], axis=0)
+      quantile_values[code] = _linear_quantiles(block, quantiles)
+
+  return {
+    "categories": categories,
+    "count": count,
+    "mean": mean,
+    "std": std,
+    "quantiles": quantile_values,
+  }
+
+def group_statistics(values, groups, quantiles=(), cache_dir=None):
+  """Cached version of compute_group_statistics.
+
+  If cache_dir is given, the statistics are stored in and loaded from
+  `{cache_dir}/{hash}.npz`, where hash is computed from the content of
+  values, groups and the requested quantiles.
+  """
+  values = np.asarray(values, dtype=np.float64)
+  groups = np.asarray(groups).astype(str)
+  quantiles = tuple(float(q) for q in quantiles)
+
+  if cache_dir is None:
+    return compute_group_statistics(values, groups, quantiles)
+
+  cache_path = f"{cache_dir}/{_content_hash(values, groups, quantiles)}.npz"
+  if os.path.exists(cache_path):
+    print(f"Loading cached group statistics from {cache_path}", flush=True)
+    with np.load(cache_path) as cached:
+      return {key: cached[key] for key in cached.files}
+
+  stats = compute_group_statistics(values, groups, quantiles)
+  os.makedirs(cache_dir, exist_ok=True)
+  # write to a temporary file first so concurrent readers never see a partial file
+  tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+  np.savez(tmp_path, **stats)
+  os.replace(tmp_path, cache_path)
+  return stats
+
+def group_statistics_frame(stats, statistic, group_name, columns):
+  """Turn one statistic into a data frame like `df.groupby(group_name).<statistic>().reset_index()`"""
+  frame = pd.DataFrame(stats[statistic], columns=columns)
+  frame.insert(0, group_name, stats["categories"])
+  return frame
+
+def group_quantiles_frame(stats, group_name, quantiles):
+  """Turn the quantiles into a data frame with one column per (feature, quantile), feature-major.
+
+  The layout equals concatenating `df.groupby(group_name)[col].quantile(quantiles).unstack()`
+  over all feature columns, i.e. the quantile labels are repeated for every feature.
+  """
+  n_groups, n_quantiles, n_features = stats["quantiles"].shape
+  values = stats["quantiles"].transpose(0, 2, 1).reshape(n_groups, n_features * n_quantiles)
+  frame = pd.DataFrame(values, columns=list(quantiles) * n_features)
+  frame.insert(0, group_name, stats["categories"])
+  return frame
@@ -0,0 +1,83 @@
+from typing import NamedTuple
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+  from anndata.io import read_elem
+except ImportError:
+  from anndata.experimental import read_elem
+
+class LayerData(NamedTuple):
+  layer: np.ndarray
+  var_names: pd.Index
+  obs_codes: dict
+  obs_categories: dict
+  uns: dict
+
+def read_layer(path, layer_name, obs_columns=(), uns_keys=("dataset_id",), dtype=np.float32):
+  """Read a single layer of an h5ad file, plus integer-coded obs columns.
+
+  Only the requested layer, obs columns and uns keys are read from the file, the rest
+  of the AnnData is never loaded. If layer_name is None, no layer is read.
+
+  Parameters:
+  path: path to the h5ad file
+  layer_name: name of the layer to read
+  obs_columns: obs columns to encode as integer codes
+  uns_keys: uns entries to read
+  dtype: dtype of the returned layer
+
+  Returns:
+  LayerData with
+    layer: C-contiguous array of shape (n_obs, n_vars), or None
+    var_names: index with the var names
+    obs_codes: dict with, per obs column, an int array of shape (n_obs,)
+    obs_categories: dict with, per obs column, the sorted unique values the codes refer to
+    uns: dict with the requested uns entries
+  """
+  with h5py.File(path, "r") as file:
+    layer = None
+    if layer_name is not None:
+      layer = file["layers"][layer_name]
+      if isinstance(layer, h5py.Dataset):
+        layer = np.ascontiguousarray(layer[...], dtype=dtype)
+      else:
+        layer = np.ascontiguousarray(read_elem(layer).toarray(), dtype=dtype)
+
+    var_names = read_elem(file["var"]).index
+
+    obs_codes, obs_categories = {}, {}
+    for col in obs_columns:
+      values = np.asarray(read_elem(file["obs"][col])).astype(str)
+      obs_categories[col], obs_codes[col] = np.unique(values, return_inverse=True)
+
+    uns = {key: read_elem(file["uns"][key]) for key in uns_keys}
+
+  return LayerData(layer, var_names, obs_codes, obs_categories, uns)
+
+def grouped_mean(values, codes, n_groups=None):
+  """Mean of the rows of values per group code, accumulated in float64.
+
+  Returns an array of shape (n_groups, n_features) with the dtype of values.
+  Groups without rows get NaN.
+  """
+  n_groups = codes.max() + 1 if n_groups is None else n_groups
+  order = np.argsort(codes, kind="stable")
+  count = np.bincount(codes, minlength=n_groups)
+  sums = np.zeros((n_groups, values.shape[1]), dtype=np.float64)
+  present = count > 0
+  starts = np.concatenate([[0], np.cumsum(count)[:-1]])[present]
+  sums[present] = np.add.reduceat(values[order], starts, axis=0, dtype=np.float64)
+  with np.errstate(invalid="ignore"):
+    return (sums / count[:, None]).astype(values.dtype)
+
+def lookup_codes(categories, values):
+  """Codes of values in the sorted categories, raises a KeyError for unknown values"""
+  values = np.asarray(values).astype(str)
+  codes = np.searchsorted(categories, values)
+  codes = np.minimum(codes, len(categories) - 1)
+  missing = categories[codes] != values
+  if missing.any():
+    raise KeyError(f"Unknown values: {sorted(set(values[missing]))}")
+  return codes
@@ -0,0 +1,52 @@
+import os
+import multiprocessing as mp
+import torch
+
+def available_cores():
+  """Cores the current process is allowed to run on"""
+  if hasattr(os, "sched_getaffinity"):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count()))
+
+def fork_safe_threads(threads_per_worker):
+  """Number of torch threads a forked worker can safely use.
+
+  libgomp, the OpenMP runtime of torch, is not fork-safe: once the parent process has run
+  a parallel torch op, the first parallel op in a forked child deadlocks. A parent that keeps
+  torch at a single thread (`torch.set_num_threads(1)` before any torch work) never starts
+  the OpenMP threads. Otherwise the workers are limited to a single thread, which does not
+  enter OpenMP at all.
+  """
+  if threads_per_worker > 1 and torch.get_num_threads() > 1:
+    print(
+      f"Using 1 thread per worker instead of {threads_per_worker}: torch may already have used "
+      f"{torch.get_num_threads()} threads in this process, which makes multithreaded forked workers deadlock",
+      flush=True
+    )
+    return 1
+  return threads_per_worker
+
+def init_worker(counter, threads_per_worker, pin_cores=True):
+  """Pool initializer, which caps the torch threads of a worker and pins it to its own cores"""
+  with counter.get_lock():
+    worker_idx = counter.value
+    counter.value += 1
+  torch.set_num_threads(threads_per_worker)
+  torch.set_num_interop_threads(1)
+  if pin_cores and hasattr(os, "sched_setaffinity"):
+    cores = available_cores()
+    start = (worker_idx * threads_per_worker) % len(cores)
+    os.sched_setaffinity(0, cores[start:start + threads_per_worker] or cores)
+
+def fork_pool(n_workers, threads_per_worker=1, pin_cores=True):
+  """Create a pool of n_workers forked processes running threads_per_worker torch threads each.
+
+  The workers are forked, since spawned workers would re-execute the calling viash script,
+  and they inherit the memory of the parent. The number of threads is reduced to one
+  when forking would not be safe (see `fork_safe_threads`).
+  """
+  threads_per_worker = fork_safe_threads(threads_per_worker)
+  print(f"Starting {n_workers} workers with {threads_per_worker} thread(s) each", flush=True)
+  ctx = mp.get_context("fork")
+  counter = ctx.Value("i", 0)
+  return ctx.Pool(n_workers, initializer=init_worker, initargs=(counter, threads_per_worker, pin_cores))
@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pandas as pd
+import anndata as ad
+
+def write_prediction(path, rows, row_index, obs_names, var_names, uns, chunk_bytes=2**20, compression="gzip"):
+  """Write a prediction h5ad whose rows are taken from a small table of distinct rows.
+
+  The "prediction" layer equals `rows[row_index]`, but it is written in chunks of about
+  `chunk_bytes`, so the full matrix is never materialized in memory. Chunks that are all zero
+  are not written at all, since they read back as the fill value of the dataset.
+
+  Parameters:
+  path: output h5ad path
+  rows: array of shape (n_distinct_rows, n_vars) with the distinct prediction rows
+  row_index: int array of shape (n_obs,) with the row of `rows` to use for every obs
+  obs_names, var_names: names of the obs and var
+  uns: dict written to uns
+  chunk_bytes: approximate size of an HDF5 chunk
+  compression: HDF5 compression filter
+  """
+  rows = np.asarray(rows, dtype=np.float32)
+  row_index = np.asarray(row_index)
+  shape = (len(row_index), rows.shape[1])
+
+  output = ad.AnnData(
+    obs=pd.DataFrame(index=obs_names),
+    var=pd.DataFrame(index=var_names),
+    uns=uns
+  )
+  output.write_h5ad(path)
+
+  chunk_rows = int(max(1, min(shape[0], chunk_bytes // max(1, rows.shape[1] * rows.itemsize))))
+  with h5py.File(path, "a") as file:
+    layers = file.require_group("layers")
+    layers.attrs.setdefault("encoding-type", "dict")
+    layers.attrs.setdefault("encoding-version", "0.1.0")
+    dataset = layers.create_dataset(
+      "prediction",
+      shape=shape,
+      dtype=rows.dtype,
+      chunks=(chunk_rows, shape[1]) if shape[0] > 0 else None,
+      compression=compression if shape[0] > 0 else None,
+      shuffle=shape[0] > 0,
+      fillvalue=0
+    )
+    dataset.attrs["encoding-type"] = "array"
+    dataset.attrs["encoding-version"] = "0.2.0"
+    for start in range(0, shape[0], chunk_rows):
+      index = row_index[start:start + chunk_rows]
+      if not rows[np.unique(index)].any():
+        continue
+      dataset[start:start + len(index)] = rows[index]
+
+def write_constant_prediction(path, row, obs_names, var_names, uns, **kwargs):
+  """Write a prediction h5ad in which every obs gets the same prediction row"""
+  row = np.asarray(row).reshape(1, -1)
+  write_prediction(path, row, np.zeros(len(obs_names), dtype=int), obs_names, var_names, uns, **kwargs)
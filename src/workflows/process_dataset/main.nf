@@ -11,7 +11,10 @@ workflow run_wf {
     )
 
     | compute_pseudobulk.run(
-      fromState: [input: "filtered_sc_counts"],
+      fromState: [
+        input: "filtered_sc_counts",
+        bootstrap_manifest: "bootstrap_manifest"
+      ],
       toState: [pseudobulk: "output"]
     )
 
@@ -15,22 +15,13 @@ workflow run_wf {
   main:
   output_ch = input_ch
 
-    // flatten bootstraps
-    | flatMap { id, state -> 
-      return (1..state.bootstrap_num_replicates).collect{ idx ->
-        [
-          "${id}-bootstrap${idx}",
-          state + [
-            replicate: idx,
-            _meta: [join_id: id]
-          ]
-        ]
-      }
-    }
-
     | bootstrap.run(
       fromState: [
         input: "sc_counts",
+        num_replicates: "bootstrap_num_replicates",
+        seed: "bootstrap_seed",
+        compression: "bootstrap_compression",
+        output_format: "bootstrap_output_format",
         bootstrap_obs: "bootstrap_obs",
         obs_fraction: "bootstrap_obs_fraction",
         obs_replace: "bootstrap_obs_replace",
@@ -39,14 +30,33 @@ workflow run_wf {
         var_replace: "bootstrap_var_replace"
       ],
       toState: [
-        sc_counts: "output"
+        sc_counts_bootstraps: "output"
       ]
     )
 
+    // flatten bootstraps
+    | flatMap { id, state -> 
+      def bootstraps = state.sc_counts_bootstraps instanceof List ? state.sc_counts_bootstraps : [state.sc_counts_bootstraps]
+      def is_manifest = state.bootstrap_output_format == "manifest"
+      return bootstraps.withIndex().collect{ bootstrap, idx ->
+        [
+          "${id}-bootstrap${idx + 1}",
+          state + [
+            // manifests are applied to the original single-cell counts
+            sc_counts: is_manifest ? state.sc_counts : bootstrap,
+            bootstrap_manifest: is_manifest ? bootstrap : null,
+            replicate: idx + 1,
+            _meta: [join_id: id]
+          ]
+        ]
+      }
+    }
+
     | process_dataset.run(
       fromState: {id, state ->
         [
           sc_counts: state.sc_counts,
+          bootstrap_manifest: state.bootstrap_manifest,
           dataset_id: id,
           dataset_name: "/",
           dataset_url: "/",